@@ -0,0 +1,110 @@
+# Пропускная способность Publisher при разном размере пула каналов.
+# Вместо воркеров с моделью запросы обслуживает заглушка, которая сразу отвечает пустым результатом,
+# так что измеряется только путь API -> брокер -> API. Отдельно меряется одна публикация с подтверждением
+# брокера: на каждом канале пула одновременно ждут подтверждения много публикаций, и чем меньше каналов,
+# тем крупнее пачки подтверждений. Нужен запущенный RabbitMQ, например:
+#   docker compose up -d rabbitmq
+#   docker compose run --rm api python benchmark.py --requests 2000 --concurrency 128 --pool-sizes 1,4,8
+import argparse
+import asyncio
+import json
+import os
+import statistics
+import time
+
+import aio_pika
+
+from utils import Publisher
+
+BENCHMARK_QUEUE = 'benchmark.model_inference'
+
+
+# заглушка воркера: отвечает на каждую задачу сразу, как Consumer.send_reply
+async def run_echo_worker(connection):
+    channel = await connection.channel()
+    await channel.set_qos(prefetch_count=256)
+    # параметры очереди совпадают с Publisher.create_channel
+    queue = await channel.declare_queue(BENCHMARK_QUEUE, durable=True)
+
+    async def on_message(message):
+        async with message.process():
+            await channel.default_exchange.publish(
+                aio_pika.Message(
+                    body=json.dumps({'event': 'result', 'result': [], 'error': '', 'info': {}}).encode(),
+                    correlation_id=message.correlation_id,
+                ),
+                routing_key=message.reply_to,
+            )
+
+    await queue.consume(on_message)
+    return channel
+
+
+async def run_round(pool_size: int, requests: int, concurrency: int) -> dict:
+    publisher = Publisher(queue_names={'model_inference': BENCHMARK_QUEUE}, pool_size=pool_size)
+    await publisher.connect()
+
+    semaphore = asyncio.Semaphore(concurrency)
+    latencies = []
+
+    async def one_request(i):
+        async with semaphore:
+            started_at = time.perf_counter()
+            await publisher.send_message({'task': 'model_inference', 'request': i})
+            latencies.append(time.perf_counter() - started_at)
+
+    # прогрев: открываем каналы пула
+    await asyncio.gather(*[one_request(-1) for _ in range(pool_size)])
+    latencies.clear()
+
+    started_at = time.perf_counter()
+    await asyncio.gather(*[one_request(i) for i in range(requests)])
+    elapsed = time.perf_counter() - started_at
+
+    # только публикация до подтверждения брокером, без ожидания ответа воркера
+    async def one_publish(i):
+        async with semaphore:
+            await publisher.publish({'task': 'model_inference', 'request': i}, correlation_id=f'publish-{i}')
+
+    started_at = time.perf_counter()
+    await asyncio.gather(*[one_publish(i) for i in range(requests)])
+    publish_elapsed = time.perf_counter() - started_at
+
+    await publisher.disconnect()
+
+    latencies.sort()
+    return {
+        'pool_size': pool_size,
+        'rps': requests / elapsed,
+        'publish_rps': requests / publish_elapsed,
+        'p50_ms': statistics.median(latencies) * 1000,
+        'p99_ms': latencies[int(len(latencies) * 0.99) - 1] * 1000,
+    }
+
+
+async def main():
+    parser = argparse.ArgumentParser(description='Publisher throughput benchmark')
+    parser.add_argument('--requests', type=int, default=2000)
+    parser.add_argument('--concurrency', type=int, default=128)
+    parser.add_argument('--pool-sizes', type=str, default='1,4,8')
+    args = parser.parse_args()
+
+    connection = await aio_pika.connect_robust(
+        f"amqp://{os.environ.get('RABBITMQ_DEFAULT_USER')}:{os.environ.get('RABBITMQ_DEFAULT_PASS')}@{os.environ.get('RABBITMQ_HOST')}:{os.environ.get('RABBITMQ_PORT')}/",
+        client_properties={"connection_name": "benchmark-worker"},
+    )
+    worker_channel = await run_echo_worker(connection)
+
+    print(f"requests={args.requests} concurrency={args.concurrency}")
+    print(f"{'pool':>6} {'req/s':>10} {'p50, ms':>10} {'p99, ms':>10} {'publish/s':>10}")
+    for pool_size in [int(size) for size in args.pool_sizes.split(',')]:
+        result = await run_round(pool_size, args.requests, args.concurrency)
+        print(f"{result['pool_size']:>6} {result['rps']:>10.1f} {result['p50_ms']:>10.2f} {result['p99_ms']:>10.2f} {result['publish_rps']:>10.1f}")
+
+    await worker_channel.queue_delete(BENCHMARK_QUEUE)
+    await worker_channel.close()
+    await connection.close()
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
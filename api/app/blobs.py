@@ -0,0 +1,98 @@
+# https://en.wikipedia.org/wiki/Content-addressable_storage
+import contextlib
+import fcntl
+import os
+import pathlib
+import shutil
+import threading
+import uuid
+
+
+class BlobStore():
+    # каждая загруженная картинка хранится один раз: root/ab/abcdef..., где имя - sha256 содержимого;
+    # папки пользователей состоят из жестких ссылок на эти файлы, поэтому счетчик ссылок на blob -
+    # это st_nlink файла минус сам blob, и отдельно его хранить не нужно.
+    # root должен быть на той же файловой системе, что и папки пользователей
+    def __init__(self, root: str):
+        self.root = pathlib.Path(root)
+        self.tmp_dir = self.root / "tmp"
+        self.tmp_dir.mkdir(parents=True, exist_ok=True)
+
+        # https://man7.org/linux/man-pages/man2/flock.2.html
+        # появление, ссылки и удаление blob'ов идут под общей блокировкой: между потоками - RLock,
+        # между процессами API - flock на файле; вложенные locked() в одном потоке берут flock один раз
+        self.lock_path = self.root / ".lock"
+        self.thread_lock = threading.RLock()
+        self.lock_depth = 0
+        self.lock_file = None
+
+    @contextlib.contextmanager
+    def locked(self):
+        with self.thread_lock:
+            if self.lock_depth == 0:
+                self.lock_file = open(self.lock_path, "a")
+                fcntl.flock(self.lock_file, fcntl.LOCK_EX)
+            self.lock_depth += 1
+            try:
+                yield
+            finally:
+                self.lock_depth -= 1
+                if self.lock_depth == 0:
+                    # закрытие файла снимает flock
+                    self.lock_file.close()
+                    self.lock_file = None
+
+    def path(self, digest: str) -> pathlib.Path:
+        return self.root / digest[:2] / digest
+
+    def exists(self, digest: str) -> bool:
+        return self.path(digest).exists()
+
+    def refcount(self, digest: str) -> int:
+        try:
+            return self.path(digest).stat().st_nlink - 1
+        except FileNotFoundError:
+            return 0
+
+    def tmp_path(self) -> pathlib.Path:
+        return self.tmp_dir / f"{uuid.uuid4().hex}.part"
+
+    # переносит дописанный временный файл в хранилище; если такой blob уже есть, временный файл удаляется
+    def put(self, tmp_path: pathlib.Path, digest: str) -> pathlib.Path:
+        path = self.path(digest)
+        with self.locked():
+            if path.exists():
+                tmp_path.unlink()
+            else:
+                path.parent.mkdir(exist_ok=True)
+                os.replace(tmp_path, path)
+        return path
+
+    # source - открытый файл с тем же содержимым: если blob успели удалить после проверки exists(),
+    # он записывается заново, и ссылка создается под той же блокировкой
+    def link(self, digest: str, dst: pathlib.Path, source=None):
+        with self.locked():
+            try:
+                os.link(self.path(digest), dst)
+            except FileNotFoundError:
+                if source is None:
+                    raise
+                tmp_path = self.tmp_path()
+                try:
+                    source.seek(0)
+                    with open(tmp_path, "wb") as out_file:
+                        shutil.copyfileobj(source, out_file)
+                    self.put(tmp_path, digest)
+                finally:
+                    tmp_path.unlink(missing_ok=True)
+                os.link(self.path(digest), dst)
+
+    # удаляет blob'ы, на которые больше не ссылается ни одна папка пользователя
+    def release(self, digests: list[str]) -> int:
+        removed = 0
+        with self.locked():
+            for digest in digests:
+                if self.refcount(digest) == 0:
+                    self.path(digest).unlink(missing_ok=True)
+                    removed += 1
+        return removed
@@ -0,0 +1,148 @@
+# https://en.wikipedia.org/wiki/Deficit_round_robin
+import asyncio
+from collections import OrderedDict, deque
+
+
+class Job():
+    def __init__(self, cost: int, future: asyncio.Future):
+        self.cost = cost
+        self.future = future
+
+
+class FairQueue():
+    # задачи разных пользователей отправляются воркерам по очереди (deficit round-robin),
+    # стоимость задачи - число картинок, поэтому пользователь с большими запросами ходит реже;
+    # у каждого пользователя не больше max_in_flight задач у воркеров,
+    # всего у воркеров не больше max_dispatched задач, остальные ждут здесь.
+    # Очередь живет в одном процессе; slots - общий для всех процессов API учет мест у воркеров
+    # (claim(user) -> bool, release(user)): задача уходит, только если место нашлось и там,
+    # а места, освобожденные другими процессами, проверяются раз в poll_interval секунд
+    def __init__(self, max_in_flight: int = 1, max_dispatched: int = 4, quantum: int = 4, slots=None, poll_interval: float = 1.0):
+        self.max_in_flight = max_in_flight
+        self.max_dispatched = max_dispatched
+        self.quantum = quantum
+        self.slots = slots
+        self.poll_interval = poll_interval
+        self.retry_handle = None
+
+        # user -> deque[Job], порядок = порядок обхода
+        self.queues = OrderedDict()
+        self.deficits = {}
+        self.in_flight = {}
+
+    async def run(self, user: str, cost: int, send):
+        await self.acquire(user, cost)
+        try:
+            return await send()
+        finally:
+            self.release(user)
+
+    # ждет очереди пользователя; после acquire обязательно вызвать release
+    async def acquire(self, user: str, cost: int):
+        job = Job(cost=max(1, cost), future=asyncio.get_running_loop().create_future())
+        self.queues.setdefault(user, deque()).append(job)
+        self.deficits.setdefault(user, 0)
+        self.dispatch()
+
+        try:
+            await job.future
+        except asyncio.CancelledError:
+            # клиент ушел, пока задача ждала очереди
+            self.remove(user, job)
+            raise
+
+    def remove(self, user: str, job: Job):
+        queue = self.queues.get(user)
+        if queue is not None and job in queue:
+            queue.remove(job)
+            if not queue:
+                self.drop(user)
+        elif job.future.done() and not job.future.cancelled():
+            # слот уже выдан, но задача так и не была отправлена
+            self.release(user)
+
+    def release(self, user: str):
+        if self.slots is not None:
+            self.slots.release(user)
+        self.in_flight[user] -= 1
+        if not self.in_flight[user]:
+            del self.in_flight[user]
+        if user in self.queues:
+            # пользователь, чья задача только что закончилась, ходит последним
+            self.queues.move_to_end(user)
+        self.dispatch()
+
+    def drop(self, user: str):
+        # пустая очередь не копит дефицит
+        del self.queues[user]
+        del self.deficits[user]
+
+    def dispatched(self) -> int:
+        return sum(self.in_flight.values())
+
+    def dispatch(self):
+        # пользователи, которым не нашлось общего места - их задачи ждут следующей проверки
+        blocked = set()
+        while self.queues and self.dispatched() < self.max_dispatched:
+            eligible = [
+                user for user in self.queues
+                if user not in blocked and self.in_flight.get(user, 0) < self.max_in_flight
+            ]
+            if not eligible:
+                # все ждущие пользователи уперлись в свой лимит
+                break
+
+            for user in eligible:
+                if self.dispatched() >= self.max_dispatched:
+                    break
+
+                queue = self.queues[user]
+                self.deficits[user] += self.quantum
+                while (
+                    queue
+                    and queue[0].cost <= self.deficits[user]
+                    and self.in_flight.get(user, 0) < self.max_in_flight
+                    and self.dispatched() < self.max_dispatched
+                ):
+                    job = queue[0]
+                    if job.future.done():
+                        # отмененная задача, ее удалит run
+                        queue.popleft()
+                        continue
+                    if self.slots is not None and not self.slots.claim(user):
+                        # место занято задачами других процессов - квант этого круга не засчитываем
+                        self.deficits[user] = max(0, self.deficits[user] - self.quantum)
+                        blocked.add(user)
+                        break
+                    queue.popleft()
+                    self.deficits[user] -= job.cost
+                    self.in_flight[user] = self.in_flight.get(user, 0) + 1
+                    job.future.set_result(None)
+
+                if queue:
+                    self.queues.move_to_end(user)
+                else:
+                    self.drop(user)
+
+        if blocked and self.queues and self.retry_handle is None:
+            self.retry_handle = asyncio.get_running_loop().call_later(self.poll_interval, self.retry)
+
+    def retry(self):
+        self.retry_handle = None
+        self.dispatch()
+
+    def stats(self) -> dict:
+        users = set(self.queues) | set(self.in_flight)
+        return {
+            "dispatched": self.dispatched(),
+            "max_dispatched": self.max_dispatched,
+            "max_in_flight": self.max_in_flight,
+            "users": {
+                user: {
+                    "queued": len(self.queues.get(user, ())),
+                    "in_flight": self.in_flight.get(user, 0),
+                    "deficit": self.deficits.get(user, 0),
+                }
+                for user in sorted(users)
+            },
+        }
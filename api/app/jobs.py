@@ -0,0 +1,212 @@
+# https://docs.python.org/3/library/sqlite3.html
+import asyncio
+import json
+import os
+import pathlib
+import socket
+import sqlite3
+import time
+import uuid
+
+# queued - ждет в справедливой очереди API, running - отправлена воркерам, done/error/cancelled - завершена
+FINISHED = ('done', 'error', 'cancelled')
+
+
+class JobStore():
+    # состояние задач лежит в sqlite рядом с остальными данными и переживает перезапуск API;
+    # ожидающие long-poll запросы будятся при каждом изменении задачи в этом процессе,
+    # а изменения из других процессов API видят, перечитывая задачу раз в poll_interval секунд
+    def __init__(self, path: str, poll_interval: float = 1.0):
+        self.poll_interval = poll_interval
+        self.path = pathlib.Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+
+        self.db = sqlite3.connect(self.path, isolation_level=None, check_same_thread=False)
+        self.db.row_factory = sqlite3.Row
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute('''
+            CREATE TABLE IF NOT EXISTS jobs (
+                id TEXT PRIMARY KEY,
+                fio TEXT NOT NULL,
+                task TEXT NOT NULL,
+                params TEXT NOT NULL,
+                status TEXT NOT NULL,
+                progress TEXT,
+                images TEXT NOT NULL DEFAULT '[]',
+                error TEXT NOT NULL DEFAULT '',
+                info TEXT NOT NULL DEFAULT '{}',
+                created_at REAL NOT NULL,
+                updated_at REAL NOT NULL,
+                owner TEXT,
+                contact_sheet TEXT
+            )
+        ''')
+        # места у воркеров, занятые задачами всех процессов API (см. SharedSlots)
+        self.db.execute('''
+            CREATE TABLE IF NOT EXISTS slots (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                task TEXT NOT NULL,
+                user TEXT NOT NULL,
+                owner TEXT NOT NULL
+            )
+        ''')
+        # база могла быть создана до появления этих колонок
+        columns = [row['name'] for row in self.db.execute('PRAGMA table_info(jobs)')]
+        for column in ('owner', 'contact_sheet'):
+            if column not in columns:
+                self.db.execute(f'ALTER TABLE jobs ADD COLUMN {column} TEXT')
+
+        # процесс API, который держит задачу в своей очереди; после перезапуска контейнера
+        # хост и pid (обычно 1) те же, поэтому владельца отличает еще и время старта процесса
+        self.owner = f'{socket.gethostname()}:{os.getpid()}:{process_start_time(os.getpid())}'
+
+        # job_id -> asyncio.Event, пересоздается после каждого изменения
+        self.changed = {}
+
+    def create(self, fio: str, params: dict) -> str:
+        job_id = str(uuid.uuid4())
+        now = time.time()
+        self.db.execute(
+            'INSERT INTO jobs (id, fio, task, params, status, created_at, updated_at, owner) VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+            (job_id, fio, params['task'], json.dumps(params, ensure_ascii=False), 'queued', now, now, self.owner)
+        )
+        return job_id
+
+    def get(self, job_id: str) -> dict | None:
+        row = self.db.execute('SELECT * FROM jobs WHERE id = ?', (job_id,)).fetchone()
+        if row is None:
+            return None
+        job = dict(row)
+        job['params'] = json.loads(job['params'])
+        job['progress'] = json.loads(job['progress']) if job['progress'] else None
+        job['images'] = json.loads(job['images'])
+        job['info'] = json.loads(job['info'])
+        return job
+
+    def update(self, job_id: str, **fields):
+        for name in ('progress', 'images', 'info'):
+            if name in fields:
+                fields[name] = json.dumps(fields[name], ensure_ascii=False)
+        fields['updated_at'] = time.time()
+
+        columns = ', '.join(f'{name} = ?' for name in fields)
+        self.db.execute(f'UPDATE jobs SET {columns} WHERE id = ?', (*fields.values(), job_id))
+
+        event = self.changed.pop(job_id, None)
+        if event is not None:
+            event.set()
+
+    def add_image(self, job_id: str, image: str):
+        job = self.get(job_id)
+        if job is not None and image not in job['images']:
+            self.update(job_id, images=job['images'] + [image])
+
+    # незавершенные задачи процесса, который больше не работает: queued - еще не отправлены воркерам,
+    # running - отправлены, и кто-то должен дождаться их ответа или срока; несколько процессов API
+    # могут стартовать одновременно, поэтому задача забирается атомарно (compare-and-set по owner)
+    def claim_orphans(self) -> list[dict]:
+        claimed = []
+        for job in self.unfinished(statuses=('queued', 'running')):
+            if job['owner'] == self.owner or owner_alive(job['owner']):
+                continue
+            cursor = self.db.execute(
+                'UPDATE jobs SET owner = ? WHERE id = ? AND owner IS ?',
+                (self.owner, job['id'], job['owner'])
+            )
+            if cursor.rowcount == 1:
+                claimed.append(job)
+        return claimed
+
+    # места занимаются одним INSERT ... SELECT с проверкой счетчиков: sqlite выполняет его под блокировкой записи,
+    # поэтому два процесса не займут одно и то же последнее место
+    def claim_slot(self, task: str, user: str, max_in_flight: int, max_dispatched: int) -> bool:
+        cursor = self.db.execute(
+            '''
+            INSERT INTO slots (task, user, owner)
+            SELECT ?, ?, ?
+            WHERE (SELECT COUNT(*) FROM slots WHERE task = ? AND user = ?) < ?
+              AND (SELECT COUNT(*) FROM slots WHERE task = ?) < ?
+            ''',
+            (task, user, self.owner, task, user, max_in_flight, task, max_dispatched)
+        )
+        return cursor.rowcount == 1
+
+    def release_slot(self, task: str, user: str):
+        self.db.execute(
+            'DELETE FROM slots WHERE id = (SELECT id FROM slots WHERE task = ? AND user = ? AND owner = ? LIMIT 1)',
+            (task, user, self.owner)
+        )
+
+    # места процессов, которые больше не работают
+    def release_orphan_slots(self) -> int:
+        owners = [row['owner'] for row in self.db.execute('SELECT DISTINCT owner FROM slots')]
+        removed = 0
+        for owner in owners:
+            if owner != self.owner and not owner_alive(owner):
+                removed += self.db.execute('DELETE FROM slots WHERE owner = ?', (owner,)).rowcount
+        return removed
+
+    def unfinished(self, statuses: tuple[str, ...]) -> list[dict]:
+        placeholders = ', '.join('?' for _ in statuses)
+        rows = self.db.execute(
+            f'SELECT id FROM jobs WHERE status IN ({placeholders}) ORDER BY created_at',
+            statuses
+        ).fetchall()
+        return [self.get(row['id']) for row in rows]
+
+    # ждет, пока задача изменится позже updated_after, не дольше timeout секунд
+    async def wait(self, job_id: str, timeout: float, updated_after: float) -> dict | None:
+        loop = asyncio.get_running_loop()
+        until = loop.time() + timeout
+        while True:
+            job = self.get(job_id)
+            if job is None or job['updated_at'] > updated_after or loop.time() >= until:
+                return job
+
+            event = self.changed.get(job_id)
+            if event is None:
+                event = self.changed[job_id] = asyncio.Event()
+            try:
+                await asyncio.wait_for(event.wait(), min(self.poll_interval, until - loop.time()))
+            except asyncio.TimeoutError:
+                pass
+
+    def close(self):
+        self.db.close()
+
+
+class SharedSlots():
+    # лимиты FairQueue для всех процессов API вместе (воркеров uvicorn), а не для каждого по отдельности
+    def __init__(self, store: JobStore, task: str, max_in_flight: int, max_dispatched: int):
+        self.store = store
+        self.task = task
+        self.max_in_flight = max_in_flight
+        self.max_dispatched = max_dispatched
+
+    def claim(self, user: str) -> bool:
+        return self.store.claim_slot(self.task, user, self.max_in_flight, self.max_dispatched)
+
+    def release(self, user: str):
+        self.store.release_slot(self.task, user)
+
+
+# https://man7.org/linux/man-pages/man5/proc_pid_stat.5.html
+# время старта процесса в тиках с загрузки системы (поле 22 /proc/<pid>/stat), None - процесса нет
+def process_start_time(pid: int) -> str | None:
+    try:
+        stat = pathlib.Path(f'/proc/{pid}/stat').read_text()
+    except OSError:
+        return None
+    # имя процесса в скобках может содержать пробелы, поля считаем после него
+    return stat.rpartition(')')[2].split()[19]
+
+
+# владелец жив, если это процесс на этом же хосте (в том же контейнере), который еще существует
+# и запущен тогда же; владельцы в старом формате host:pid остались от процессов до перезапуска
+def owner_alive(owner: str | None) -> bool:
+    if not owner:
+        return False
+    host, pid, start_time = (owner.split(':') + [None])[:3]
+    if host != socket.gethostname() or start_time is None or not pid.isdigit():
+        return False
+    return process_start_time(int(pid)) == start_time
@@ -1,13 +1,21 @@
+import asyncio
+import json
+import os
 import pathlib
+import time
 from contextlib import asynccontextmanager
 from enum import Enum
 from typing import Annotated
 
-import aiofiles
-from fastapi import Depends, FastAPI, Form, Request, UploadFile
+from fastapi import Depends, FastAPI, Form, HTTPException, Query, Request, UploadFile
+from fastapi.responses import StreamingResponse
 from fastapi.staticfiles import StaticFiles
-from pydantic import BaseModel
+from pydantic import BaseModel, Field
 
+from blobs import BlobStore
+from fair_queue import FairQueue
+from jobs import FINISHED, JobStore, SharedSlots
+from uploads import UploadSizeLimitMiddleware, save_uploads
 from utils import Publisher, translit
 
 APP_DIR = pathlib.Path(__file__).parent.resolve()
@@ -17,17 +25,71 @@ STATIC_DIR = STORAGE_DIR / "static"
 STATIC_DIR.mkdir(parents=True, exist_ok=True)
 
 publisher = Publisher()
+jobs = JobStore(STORAGE_DIR / "jobs.sqlite3")
+# загруженные фото по sha256, папки пользователей - жесткие ссылки на них
+blobs = BlobStore(STORAGE_DIR / "blobs")
+
+# job_id -> фоновая задача asyncio (заодно ссылка, чтобы ее не собрал сборщик мусора)
+job_tasks = {}
+
+# срок задачи в секундах с момента отправки: просроченную задачу воркер не начинает, а начатую прерывает
+TASK_TIMEOUTS = {
+    "model_train": float(os.environ.get('TASK_TIMEOUT_TRAIN', 3600)),
+    "model_inference": float(os.environ.get('TASK_TIMEOUT_INFERENCE', 600)),
+}
+
+# дольше этого long-poll не ждет, чтобы укладываться в обычный таймаут прокси
+JOB_MAX_WAIT = 60
+# запас после срока задачи на доставку ответа воркера; после него задача считается просроченной
+JOB_RESULT_GRACE = 60
+
+# справедливая очередь перед воркерами: пользователи отправляют задачи по очереди,
+# у каждого не больше FAIR_QUEUE_MAX_IN_FLIGHT задач у воркеров одновременно;
+# порядок очереди свой в каждом процессе API, а лимиты общие для всех процессов - места учитываются в jobs
+FAIR_QUEUE_MAX_IN_FLIGHT = int(os.environ.get('FAIR_QUEUE_MAX_IN_FLIGHT', 1))
+FAIR_QUEUE_MAX_DISPATCHED = {
+    "model_train": int(os.environ.get('FAIR_QUEUE_MAX_DISPATCHED_TRAIN', 1)),
+    "model_inference": int(os.environ.get('FAIR_QUEUE_MAX_DISPATCHED_INFERENCE', 4)),
+}
+fair_queues = {
+    task: FairQueue(
+        max_in_flight=FAIR_QUEUE_MAX_IN_FLIGHT,
+        max_dispatched=max_dispatched,
+        slots=SharedSlots(jobs, task, max_in_flight=FAIR_QUEUE_MAX_IN_FLIGHT, max_dispatched=max_dispatched),
+    )
+    for task, max_dispatched in FAIR_QUEUE_MAX_DISPATCHED.items()
+}
+
+
+async def send_task(fio: str, params: dict) -> dict:
+    return await fair_queues[params["task"]].run(
+        user=fio,
+        cost=params.get("num_images", 1),
+        send=lambda: publisher.send_message(params, timeout=TASK_TIMEOUTS[params["task"]]),
+    )
 
 
 # https://fastapi.tiangolo.com/advanced/events/#lifespan
 @asynccontextmanager
 async def lifespan(app: FastAPI):
     await publisher.connect()
+    await publisher.consume_job_results(on_job_result)
+    # места у воркеров, которые держали процессы до перезапуска
+    jobs.release_orphan_slots()
+    # задачи, не успевшие уйти воркерам до перезапуска, снова встают в очередь;
+    # ответы на уже отправленные придут в постоянную очередь job_results, а их срок снова отслеживается здесь
+    for job in jobs.claim_orphans():
+        if job["status"] == "queued":
+            start_job(job["id"], job["fio"], job["params"], job["created_at"])
+        else:
+            watch_job(job["id"], job["params"], job["created_at"])
     yield
     await publisher.disconnect()
+    jobs.close()
 
 
 app = FastAPI(lifespan=lifespan)
+app.add_middleware(UploadSizeLimitMiddleware)
 
 app.mount("/static", StaticFiles(directory=STATIC_DIR), name="static")
 
@@ -41,11 +103,15 @@ class Gender(str, Enum):
     Men = "men"
 
 
+MAX_IMAGES = 8
+
+
 class InputTrain(BaseModel):
     fio : str
     gender : Gender
     name_of_model: ModelName
     promt: str
+    num_images: int = Field(default=4, ge=1, le=MAX_IMAGES)
 
     # https://stackoverflow.com/questions/60127234/how-to-use-a-pydantic-model-with-form-data-in-fastapi
     @classmethod
@@ -55,32 +121,77 @@ class InputTrain(BaseModel):
         gender : Gender = Form(),
         name_of_model: ModelName = Form(),
         promt: str = Form(),
+        num_images: int = Form(default=4, ge=1, le=MAX_IMAGES),
 
     ):
-        return cls(fio=fio, gender = gender, promt=promt, name_of_model=name_of_model)
+        return cls(fio=fio, gender = gender, promt=promt, name_of_model=name_of_model, num_images=num_images)
 
 
 class InputInference(BaseModel):
     fio : str
     gender : Gender
     promt: str
+    num_images: int = Field(default=4, ge=1, le=MAX_IMAGES)
     
 
 # /{datetime.datetime.now():%Y.%m.%d_%H.%M.%S}
-def get_directories(model_name: str, fio: str, clear_image_dir: bool = False) -> tuple[str, str]:
+# работа с диском идет в отдельном потоке, чтобы не останавливать event loop
+async def get_directories(model_name: str, fio: str) -> tuple[pathlib.Path, pathlib.Path]:
     model_dir = STORAGE_DIR / f"content_{model_name}/{fio}"
     images_dir = model_dir / "data"
-    images_dir.mkdir(parents=True, exist_ok=True)
+    await asyncio.to_thread(images_dir.mkdir, parents=True, exist_ok=True)
+    return model_dir, images_dir
 
-    if clear_image_dir:
-        for file in images_dir.rglob('*'):
-            file.unlink()
 
-    return model_dir, images_dir
+# варианты, которые model_service кладет рядом с картинкой (encoding.py):
+# tatto0.png -> tatto0.telegram.jpg - jpeg под размер Telegram
+IMAGE_VARIANTS = {"telegram": ".telegram.jpg"}
+# сетка всех картинок запроса в папке результата
+CONTACT_SHEET_NAME = "contact_sheet.jpg"
+
+
+def variant_path(path: pathlib.PurePath, variant: str) -> pathlib.PurePath:
+    return path.with_name(f"{path.stem}{IMAGE_VARIANTS[variant]}")
+
+
+# для каждой картинки урлы оригинала и всех ее вариантов: {"original": ..., "telegram": ...}
+# https://www.starlette.io/routing/#reverse-url-lookups
+def static_urls(request: Request, static_paths: list[str]) -> list[dict[str, str]]:
+    urls = []
+    for static_path in static_paths:
+        image_urls = {"original": str(request.url_for("static", path=static_path))}
+        for variant in IMAGE_VARIANTS:
+            variant_static_path = variant_path(pathlib.PurePosixPath(static_path), variant)
+            if (STATIC_DIR / variant_static_path).exists():
+                image_urls[variant] = str(request.url_for("static", path=str(variant_static_path)))
+        urls.append(image_urls)
+    return urls
+
+
+async def make_image_urls(request: Request, fio: str, generated_images: list[str]) -> list[dict[str, str]]:
+    # формируем урл до картинки и записываем в ответ
+    static_paths = await asyncio.to_thread(move_to_static, fio=fio, generated_images=generated_images)
+    return await asyncio.to_thread(static_urls, request, static_paths)
+
 
+# переносит сетку картинок из папки результата в STATIC_DIR, если model_service ее сделал
+def move_contact_sheet(fio: str, generated_images: list[str]) -> str | None:
+    if not generated_images:
+        return None
+    contact_sheet = pathlib.Path(generated_images[0]).parent / CONTACT_SHEET_NAME
+    if not contact_sheet.exists():
+        return None
+    return move_to_static(fio=fio, generated_images=[contact_sheet])[0]
 
-def make_image_urls(request: Request, fio: str, generated_images: list[str]) -> list[str]:
-    image_urls = []
+
+async def make_contact_sheet_url(request: Request, fio: str, generated_images: list[str]) -> str:
+    static_path = await asyncio.to_thread(move_contact_sheet, fio=fio, generated_images=generated_images)
+    return str(request.url_for("static", path=static_path)) if static_path else ""
+
+
+# переносит картинки вместе с их вариантами в STATIC_DIR и возвращает пути оригиналов относительно STATIC_DIR
+def move_to_static(fio: str, generated_images: list[str]) -> list[str]:
+    static_paths = []
     user_static_path = pathlib.Path(STATIC_DIR) / fio  # "app/storate/static/123/"
     user_static_path.mkdir(parents=True, exist_ok=True)
     for image_path in generated_images:
@@ -98,58 +209,101 @@ def make_image_urls(request: Request, fio: str, generated_images: list[str]) ->
             new_image_path = user_static_path / new_image_name  # "app/storate/static/123/1_tatoo0.png"
 
         image_path.rename(new_image_path)
-
-        # формируем урл до картинки и записываем в ответ
-        # https://www.starlette.io/routing/#reverse-url-lookups
-        image_urls.append(
-            str(request.url_for("static", path=f"{fio}/{new_image_name}"))
-        )
-    return image_urls
+        for variant in IMAGE_VARIANTS:
+            if variant_path(image_path, variant).exists():
+                variant_path(image_path, variant).rename(variant_path(new_image_path, variant))
+        static_paths.append(f"{fio}/{new_image_name}")
+    return static_paths
+
+
+# потоковый ответ: по строке JSON на событие задачи (https://github.com/ndjson/ndjson-spec)
+# {"event": "progress", "stage": "train", "step": 10, "total": 500}
+# {"event": "image", "url": "...", "variants": {"original": "...", "telegram": "..."}} - каждая картинка сразу после генерации
+# {"event": "result", "generated_images": [...], "variants": [...], "contact_sheet": "...", "error": "", "info": {...}} - последняя строка
+async def stream_task(request: Request, fio: str, params: dict):
+    fair_queue = fair_queues[params["task"]]
+    await fair_queue.acquire(user=fio, cost=params.get("num_images", 1))
+    try:
+        image_urls = {}
+        async for event in publisher.stream_message(params, timeout=TASK_TIMEOUTS[params["task"]]):
+            if event.get("event") == "image":
+                image_urls[event["image"]] = (await make_image_urls(request=request, fio=fio, generated_images=[event["image"]]))[0]
+                event = {"event": "image", "url": image_urls[event["image"]]["original"], "variants": image_urls[event["image"]]}
+            elif event.get("event", "result") == "result":
+                new_images = [image for image in event.get("result") or [] if image not in image_urls]
+                new_urls = await make_image_urls(request=request, fio=fio, generated_images=new_images)
+                image_urls.update(zip(new_images, new_urls))
+                variants = [image_urls[image] for image in event.get("result") or []]
+                event = {
+                    "event": "result",
+                    "generated_images": [urls["original"] for urls in variants],
+                    "variants": variants,
+                    "contact_sheet": await make_contact_sheet_url(request=request, fio=fio, generated_images=event.get("result") or []),
+                    "error": event.get("error") or "",
+                    "info": event.get("info") or {},
+                }
+            yield json.dumps(event, ensure_ascii=False) + "\n"
+    finally:
+        fair_queue.release(fio)
 
 
 #https://stackoverflow.com/questions/63580229/how-to-save-uploadfile-in-fastapi
-@app.post("/input_train/")
-async def input_train(
-    input_model: Annotated[InputTrain, Depends(InputTrain.as_form)],
-    files: list[UploadFile], 
-    request: Request
-) -> dict[str, str | list[str]]:  
+async def prepare_train(input_model: InputTrain, files: list[UploadFile]) -> tuple[str, dict]:
     fio = translit(input_model.fio)
-    model_dir, images_dir = get_directories(
+    model_dir, images_dir = await get_directories(
         model_name=input_model.name_of_model.value, 
         fio=fio, 
-        clear_image_dir=True
     )
 
-    for file in files:
-        async with aiofiles.open (images_dir/file.filename, "wb") as out_file:
-            content = await file.read()  # async read
-            await out_file.write(content)  # async write
+    # новые фото заменяют прошлые целиком; слишком большие загрузки отклоняются с 413
+    image_hashes = await save_uploads(files, images_dir, blobs)
     
     params = {
         "task": "model_train",
         "model_dir": str(model_dir), 
         "prompt": input_model.promt,
         "model_name": input_model.name_of_model.value, 
-        "type_person": input_model.gender.value
+        "type_person": input_model.gender.value,
+        "num_images": input_model.num_images,
+        "image_hashes": image_hashes,
     }
-    result = await publisher.send_message(params)
+    return fio, params
+
+
+@app.post("/input_train/")
+async def input_train(
+    input_model: Annotated[InputTrain, Depends(InputTrain.as_form)],
+    files: list[UploadFile], 
+    request: Request
+) -> dict[str, str | list[str] | list[dict[str, str]] | dict]:  
+    fio, params = await prepare_train(input_model, files)
+    result = await send_task(fio, params)
     generated_images = result.get("result") or []
     error = result.get("error") or ""
+    variants = await make_image_urls(request=request, fio=fio, generated_images=generated_images)
 
     return {
-        "generated_images": make_image_urls(request=request, fio=fio, generated_images=generated_images),
+        "generated_images": [urls["original"] for urls in variants],
+        "variants": variants,
+        "contact_sheet": await make_contact_sheet_url(request=request, fio=fio, generated_images=generated_images),
         "error": error,
+        "info": result.get("info") or {},
     }
 
 
-@app.post("/input_inference/")
-async def input_inference(
-    input_model:InputInference,
+@app.post("/input_train_stream/")
+async def input_train_stream(
+    input_model: Annotated[InputTrain, Depends(InputTrain.as_form)],
+    files: list[UploadFile], 
     request: Request
-) -> dict[str, str | list[str]]:
+) -> StreamingResponse:
+    fio, params = await prepare_train(input_model, files)
+    return StreamingResponse(stream_task(request, fio, params), media_type="application/x-ndjson")
+
+
+async def prepare_inference(input_model: InputInference) -> tuple[str, dict]:
     fio = translit(input_model.fio)
-    model_dir, images_dir = get_directories(
+    model_dir, images_dir = await get_directories(
         model_name=ModelName.Lora.value, 
         fio=fio
     )
@@ -158,13 +312,202 @@ async def input_inference(
         "task": "model_inference",
         "model_dir": str(model_dir), 
         "prompt": input_model.promt,
-        "type_person": input_model.gender.value
+        "type_person": input_model.gender.value,
+        "num_images": input_model.num_images,
     }
-    result = await publisher.send_message(params)
+    return fio, params
+
+
+@app.post("/input_inference/")
+async def input_inference(
+    input_model:InputInference,
+    request: Request
+) -> dict[str, str | list[str] | list[dict[str, str]]]:
+    fio, params = await prepare_inference(input_model)
+    result = await send_task(fio, params)
     generated_images = result.get("result") or []
     error = result.get("error") or ""
+    variants = await make_image_urls(request=request, fio=fio, generated_images=generated_images)
 
     return {
-        "generated_images": make_image_urls(request=request, fio=fio, generated_images=generated_images),
+        "generated_images": [urls["original"] for urls in variants],
+        "variants": variants,
+        "contact_sheet": await make_contact_sheet_url(request=request, fio=fio, generated_images=generated_images),
         "error": error,
-    }
\ No newline at end of file
+    }
+
+
+@app.post("/input_inference_stream/")
+async def input_inference_stream(
+    input_model:InputInference,
+    request: Request
+) -> StreamingResponse:
+    fio, params = await prepare_inference(input_model)
+    return StreamingResponse(stream_task(request, fio, params), media_type="application/x-ndjson")
+
+
+# глубина очередей по пользователям - чтобы подбирать лимиты под нагрузкой
+@app.get("/queues/")
+async def queues() -> dict[str, dict]:
+    return {task: fair_queue.stats() for task, fair_queue in fair_queues.items()}
+
+
+#--------------------------------------------------------------------------------------------------------------
+# задачи: отправка сразу возвращает id, результат забирается через GET /jobs/{id}
+def start_job(job_id: str, fio: str, params: dict, created_at: float):
+    task = job_tasks[job_id] = asyncio.create_task(run_job(job_id, fio, params, created_at))
+    task.add_done_callback(lambda _: job_tasks.pop(job_id, None))
+
+
+# задача уже у воркеров (отправлена процессом, который перезапустился) - только ждем ответа до срока
+def watch_job(job_id: str, params: dict, created_at: float):
+    give_up_at = created_at + TASK_TIMEOUTS[params["task"]] + JOB_RESULT_GRACE
+    task = job_tasks[job_id] = asyncio.create_task(wait_job_result(job_id, give_up_at, error="Task timed out"))
+    task.add_done_callback(lambda _: job_tasks.pop(job_id, None))
+
+
+async def run_job(job_id: str, fio: str, params: dict, created_at: float):
+    # срок задачи считается от момента создания, включая ожидание в очереди
+    deadline = created_at + TASK_TIMEOUTS[params["task"]]
+    fair_queue = fair_queues[params["task"]]
+    await fair_queue.acquire(user=fio, cost=params.get("num_images", 1))
+    try:
+        if time.time() > deadline:
+            jobs.update(job_id, status="error", error="Task expired")
+            return
+        jobs.update(job_id, status="running")
+        await publisher.publish(
+            {**params, "stream": True},
+            correlation_id=job_id,
+            reply_to=publisher.job_results_queue_name,
+            deadline=deadline,
+        )
+        # пока задача не завершена, она занимает место в очереди
+        await wait_job_result(job_id, deadline + JOB_RESULT_GRACE)
+    except Exception as e:
+        jobs.update(job_id, status="error", error=str(e) or type(e).__name__)
+    finally:
+        fair_queue.release(fio)
+
+
+# ответ может обработать любой процесс API - ждем завершения по хранилищу задач.
+# Просроченное сообщение брокер выбрасывает молча, и ответа на него не будет,
+# поэтому ждем не дольше give_up_at (срок задачи с запасом на доставку ответа)
+async def wait_job_result(job_id: str, give_up_at: float, error: str = "Task expired"):
+    job = jobs.get(job_id)
+    while job is not None and job["status"] not in FINISHED:
+        remaining = give_up_at - time.time()
+        if remaining <= 0:
+            jobs.update(job_id, status="error", error=error)
+            # если воркер все-таки взял задачу, пусть бросит ее
+            await publisher.cancel(job_id)
+            break
+        job = await jobs.wait(job_id, timeout=min(JOB_MAX_WAIT, remaining), updated_after=job["updated_at"])
+
+
+# события воркера по задачам /jobs; сообщение подтверждается после записи в хранилище
+async def on_job_result(message):
+    async with message.process():
+        job_id = message.correlation_id
+        job = jobs.get(job_id) if job_id else None
+        if job is None or job["status"] in FINISHED:
+            return
+
+        event = json.loads(message.body)
+        kind = event.get("event", "result")
+
+        if kind == "progress":
+            progress = {"stage": event.get("stage"), "step": event.get("step"), "total": event.get("total")}
+            jobs.update(job_id, progress=progress)
+        elif kind == "image":
+            # при повторной доставке сообщения картинка уже перенесена
+            if pathlib.Path(event["image"]).exists():
+                static_paths = await asyncio.to_thread(move_to_static, fio=job["fio"], generated_images=[event["image"]])
+                jobs.add_image(job_id, static_paths[0])
+        else:
+            # картинки, уже пришедшие отдельными событиями, перенесены раньше
+            generated_images = [image for image in event.get("result") or [] if pathlib.Path(image).exists()]
+            images = job["images"] + await asyncio.to_thread(move_to_static, fio=job["fio"], generated_images=generated_images)
+            contact_sheet = await asyncio.to_thread(move_contact_sheet, fio=job["fio"], generated_images=event.get("result") or [])
+            error = event.get("error") or ""
+            jobs.update(
+                job_id,
+                status="error" if error else "done",
+                images=images,
+                contact_sheet=contact_sheet or job["contact_sheet"],
+                error=error,
+                info=event.get("info") or {},
+            )
+
+
+async def job_response(request: Request, job: dict) -> dict:
+    variants = await asyncio.to_thread(static_urls, request, job["images"])
+    return {
+        "id": job["id"],
+        "status": job["status"],
+        "progress": job["progress"],
+        "generated_images": [urls["original"] for urls in variants],
+        "variants": variants,
+        "contact_sheet": str(request.url_for("static", path=job["contact_sheet"])) if job["contact_sheet"] else "",
+        "error": job["error"],
+        "info": job["info"],
+        "updated_at": job["updated_at"],
+    }
+
+
+@app.post("/jobs/train/", status_code=202)
+async def submit_train_job(
+    input_model: Annotated[InputTrain, Depends(InputTrain.as_form)],
+    files: list[UploadFile], 
+) -> dict[str, str]:
+    fio, params = await prepare_train(input_model, files)
+    job_id = jobs.create(fio, params)
+    start_job(job_id, fio, params, created_at=time.time())
+    return {"id": job_id, "status": "queued"}
+
+
+@app.post("/jobs/inference/", status_code=202)
+async def submit_inference_job(input_model: InputInference) -> dict[str, str]:
+    fio, params = await prepare_inference(input_model)
+    job_id = jobs.create(fio, params)
+    start_job(job_id, fio, params, created_at=time.time())
+    return {"id": job_id, "status": "queued"}
+
+
+# wait > 0 - long-poll: ответ приходит при первом изменении задачи (прогресс, картинка, результат)
+# или через wait секунд; updated_after - updated_at из прошлого ответа, более новое состояние отдается сразу
+@app.get("/jobs/{job_id}")
+async def get_job(
+    job_id: str,
+    request: Request,
+    wait: Annotated[float, Query(ge=0, le=JOB_MAX_WAIT)] = 0,
+    updated_after: float = 0,
+) -> dict:
+    job = jobs.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Job not found")
+
+    if wait > 0 and job["status"] not in FINISHED:
+        # без updated_after ждем изменения после текущего состояния
+        job = await jobs.wait(job_id, timeout=wait, updated_after=updated_after or job["updated_at"])
+
+    return await job_response(request, job)
+
+
+# отмена задачи: ждущая в очереди API просто снимается, отправленную прерывает воркер
+@app.delete("/jobs/{job_id}")
+async def cancel_job(job_id: str, request: Request) -> dict:
+    job = jobs.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Job not found")
+
+    if job["status"] not in FINISHED:
+        jobs.update(job_id, status="cancelled", error="Task cancelled")
+        if job["status"] == "running":
+            await publisher.cancel(job_id)
+        task = job_tasks.get(job_id)
+        if task is not None:
+            task.cancel()
+        job = jobs.get(job_id)
+
+    return await job_response(request, job)
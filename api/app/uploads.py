@@ -0,0 +1,160 @@
+# https://www.starlette.io/requests/#request-files
+import asyncio
+import hashlib
+import os
+import pathlib
+import re
+import shutil
+import uuid
+
+import aiofiles
+from fastapi import HTTPException, UploadFile
+from fastapi.responses import JSONResponse
+
+from blobs import BlobStore
+
+UPLOAD_CHUNK_SIZE = int(os.environ.get('UPLOAD_CHUNK_SIZE', 1024 * 1024))
+MAX_UPLOAD_FILE_BYTES = int(os.environ.get('MAX_UPLOAD_FILE_BYTES', 20 * 1024 * 1024))
+MAX_UPLOAD_REQUEST_BYTES = int(os.environ.get('MAX_UPLOAD_REQUEST_BYTES', 200 * 1024 * 1024))
+# запас на границы multipart и текстовые поля формы сверх самих файлов
+UPLOAD_FORM_OVERHEAD_BYTES = 1024 * 1024
+
+# фото в папке пользователя называются "<номер в запросе>-<sha256 содержимого>": mtime жесткой ссылки - это время
+# первой загрузки blob'а, поэтому порядок загрузки хранится в имени; остальные файлы (metadata.jsonl) не трогаем
+BLOB_NAME = re.compile(r'^(?:\d+-)?([0-9a-f]{64})(\.[^.]*)?$')
+
+
+def too_large(detail: str) -> HTTPException:
+    return HTTPException(status_code=413, detail=detail)
+
+
+# https://asgi.readthedocs.io/en/latest/specs/www.html#http
+# starlette разбирает форму раньше, чем вызывается эндпоинт или его зависимости, и складывает файлы
+# в SpooledTemporaryFile; поэтому слишком большой запрос отклоняется здесь, до разбора:
+# по Content-Length сразу, а без него (chunked) - как только прочитано больше лимита
+class UploadSizeLimitMiddleware():
+    def __init__(self, app, max_bytes: int = MAX_UPLOAD_REQUEST_BYTES + UPLOAD_FORM_OVERHEAD_BYTES):
+        self.app = app
+        self.max_bytes = max_bytes
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http':
+            return await self.app(scope, receive, send)
+        headers = dict(scope['headers'])
+        if not headers.get(b'content-type', b'').startswith(b'multipart/form-data'):
+            return await self.app(scope, receive, send)
+
+        content_length = headers.get(b'content-length')
+        if content_length is not None and content_length.isdigit() and int(content_length) > self.max_bytes:
+            response = JSONResponse({'detail': 'Request is too large'}, status_code=413)
+            return await response(scope, receive, send)
+
+        received = 0
+
+        async def limited_receive():
+            nonlocal received
+            message = await receive()
+            if message['type'] == 'http.request':
+                received += len(message.get('body', b''))
+                if received > self.max_bytes:
+                    # FastAPI пробрасывает HTTPException из разбора тела как есть
+                    raise too_large('Request is too large')
+            return message
+
+        await self.app(scope, limited_receive, send)
+
+
+# считает sha256 загрузки кусками по UPLOAD_CHUNK_SIZE, ничего не записывая на диск;
+# starlette уже держит загрузку в SpooledTemporaryFile, так что в памяти не больше одного куска;
+# limit - сколько байт еще можно принять в этом запросе
+async def hash_upload(file: UploadFile, limit: int) -> tuple[str, int]:
+    # starlette уже знает размер файла - слишком большой отклоняем, не читая
+    if file.size is not None and file.size > min(limit, MAX_UPLOAD_FILE_BYTES):
+        raise too_large(f"{file.filename}: file is too large")
+
+    sha256 = hashlib.sha256()
+    size = 0
+    while chunk := await file.read(UPLOAD_CHUNK_SIZE):
+        size += len(chunk)
+        if size > MAX_UPLOAD_FILE_BYTES:
+            raise too_large(f"{file.filename}: file is too large")
+        if size > limit:
+            raise too_large("Request is too large")
+        sha256.update(chunk)
+    return sha256.hexdigest(), size
+
+
+# копирует загрузку в хранилище, только если такого содержимого там еще нет:
+# повторная загрузка того же фото на диск ничего не пишет
+async def store_upload(file: UploadFile, digest: str, blobs: BlobStore):
+    if await asyncio.to_thread(blobs.exists, digest):
+        return
+
+    await file.seek(0)
+    tmp_path = blobs.tmp_path()
+    try:
+        async with aiofiles.open(tmp_path, "wb") as out_file:
+            while chunk := await file.read(UPLOAD_CHUNK_SIZE):
+                await out_file.write(chunk)
+        await asyncio.to_thread(blobs.put, tmp_path, digest)
+    except BaseException:
+        await asyncio.to_thread(tmp_path.unlink, missing_ok=True)
+        raise
+
+
+# кладет фото в хранилище и собирает из ссылок на них папку images_dir;
+# возвращает {имя файла: sha256} - по этим хэшам работают кэши подписей и латентов в model_service
+async def save_uploads(files: list[UploadFile], images_dir: pathlib.Path, blobs: BlobStore) -> dict[str, str]:
+    image_hashes = {}
+    sources = {}
+    total = 0
+    for file in files:
+        digest, size = await hash_upload(file, limit=MAX_UPLOAD_REQUEST_BYTES - total)
+        total += size
+        await store_upload(file, digest, blobs)
+        # одинаковые фото в одном запросе дают одно имя - по первому появлению
+        if digest not in image_hashes.values():
+            image_hashes[f"{len(image_hashes):03d}-{digest}{pathlib.Path(file.filename or '').suffix}"] = digest
+        sources[digest] = file.file
+
+    await asyncio.to_thread(link_images, image_hashes, images_dir, blobs, sources)
+    return image_hashes
+
+
+def list_images(images_dir: pathlib.Path) -> dict[str, str]:
+    if not images_dir.exists():
+        return {}
+    return {
+        path.name: match.group(1)
+        for path in images_dir.iterdir()
+        if (match := BLOB_NAME.match(path.name))
+    }
+
+
+# папка собирается рядом из жестких ссылок и подменяет images_dir целиком, так что обучение
+# не видит полусобранной папки; если фото те же, что в прошлый раз, на диск не пишется ничего.
+# Все идет под блокировкой хранилища: одновременные загрузки одного пользователя подменяют папку по очереди,
+# а release другого запроса не удалит blob между проверкой и ссылкой (sources - {sha256: файл} для повторной записи)
+def link_images(image_hashes: dict[str, str], images_dir: pathlib.Path, blobs: BlobStore, sources: dict | None = None):
+    sources = sources or {}
+    with blobs.locked():
+        old_images = list_images(images_dir)
+        if old_images == image_hashes:
+            return
+
+        # папки, оставшиеся от упавшего процесса: под блокировкой их никто не собирает
+        for stale_dir in images_dir.parent.glob(f"{images_dir.name}.upload-*"):
+            shutil.rmtree(stale_dir, ignore_errors=True)
+
+        new_dir = images_dir.with_name(f"{images_dir.name}.upload-{uuid.uuid4().hex[:8]}")
+        new_dir.mkdir(parents=True)
+        try:
+            for name, digest in image_hashes.items():
+                blobs.link(digest, new_dir / name, source=sources.get(digest))
+        except BaseException:
+            shutil.rmtree(new_dir, ignore_errors=True)
+            raise
+
+        shutil.rmtree(images_dir, ignore_errors=True)
+        new_dir.rename(images_dir)
+        blobs.release([digest for digest in set(old_images.values()) if digest not in image_hashes.values()])
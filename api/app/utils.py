@@ -2,45 +2,95 @@ import asyncio
 import json
 import os
 import re
+import socket
+import time
 import uuid
 
 import aio_pika
+from aio_pika.pool import Pool
 from tenacity import retry, stop_after_attempt
 
+# сколько каналов с подтверждениями публикации держит каждый процесс API
+PUBLISHER_CHANNELS = int(os.environ.get('PUBLISHER_CHANNELS', 4))
+
 
 class Publisher:
     # https://aio-pika.readthedocs.io/en/latest/patterns.html#rpc
     # https://github.com/mosquito/aio-pika/blob/master/aio_pika/patterns/rpc.py
 
-    def __init__(self):
+    # канал self.channel служебный: объявления очередей и получение ответов;
+    # задачи публикуются через пул каналов с подтверждениями (publisher confirms), чтобы
+    # одновременные запросы разных пользователей не выстраивались в очередь на одном канале
+    def __init__(self, queue_names: dict | None = None, pool_size: int = PUBLISHER_CHANNELS):
         self.connection = None
         self.channel = None
         self.loop = None
+        self.connect_lock = asyncio.Lock()
+
+        self.pool_size = pool_size
+        self.channel_pool = None
 
         self.result_queue = None
         self.result_consumer_tag = None
         self.result_tasks = {}
+        # correlation_id -> asyncio.Queue с промежуточными событиями задачи
+        self.result_streams = {}
         
-        self.queue_name = 'main'
+        # у каждого типа задач своя очередь, чтобы быстрый инференс не ждал обучения
+        self.queue_names = queue_names or {
+            'model_train': 'model_train',
+            'model_inference': 'model_inference',
+        }
+        # у каждого процесса API (воркера uvicorn) своя очередь ответов,
+        # ответ находит свой запрос по correlation_id
+        self.result_queue_name = f'results.{socket.gethostname()}.{os.getpid()}.{uuid.uuid4().hex[:8]}'
+        # постоянная очередь ответов для задач /jobs: ответы, пришедшие пока API перезапускался, не теряются
+        self.job_results_queue_name = 'job_results'
+        self.job_results_queue = None
+        self.job_results_consumer_tag = None
+        # отмена задачи рассылается всем воркерам
+        self.cancel_exchange_name = 'cancel'
+        self.cancel_exchange = None
 
     async def connect(self):
-        if not self.loop:
-            self.loop = asyncio.get_event_loop()
+        # обычный случай - все уже открыто, ничего не пересоздаем
+        if self.connection and not self.connection.is_closed and self.channel and not self.channel.is_closed:
+            return
 
-        if not self.connection or self.connection.is_closed:
-            self.connection = await aio_pika.connect_robust(
-                f"amqp://{os.environ.get('RABBITMQ_DEFAULT_USER')}:{os.environ.get('RABBITMQ_DEFAULT_PASS')}@{os.environ.get('RABBITMQ_HOST')}:{os.environ.get('RABBITMQ_PORT')}/?heartbeat=0",
-                client_properties={"connection_name": "caller"},
-            )
-        
-        await self.create_channel()
+        async with self.connect_lock:
+            if not self.loop:
+                self.loop = asyncio.get_event_loop()
+
+            if not self.connection or self.connection.is_closed:
+                self.connection = await aio_pika.connect_robust(
+                    f"amqp://{os.environ.get('RABBITMQ_DEFAULT_USER')}:{os.environ.get('RABBITMQ_DEFAULT_PASS')}@{os.environ.get('RABBITMQ_HOST')}:{os.environ.get('RABBITMQ_PORT')}/?heartbeat=0",
+                    client_properties={"connection_name": f"caller.{os.getpid()}"},
+                )
+
+            if self.channel_pool is None or self.channel_pool.is_closed:
+                # https://aio-pika.readthedocs.io/en/latest/examples.html#connection-pooling
+                self.channel_pool = Pool(self.create_publish_channel, max_size=self.pool_size)
+            
+            await self.create_channel()
+
+    # с publisher_confirms публикация ждет подтверждения брокера; канал возвращается в пул сразу после
+    # отправки (см. publish), поэтому на одном канале ждут подтверждения сразу несколько публикаций,
+    # и брокер подтверждает их пачкой (basic.ack с multiple=true)
+    async def create_publish_channel(self):
+        return await self.connection.channel(publisher_confirms=True)
 
     async def create_channel(self):
         if not self.channel or self.channel.is_closed:
             self.channel = await self.connection.channel()
-            await self.channel.declare_queue(self.queue_name, durable=True)
+            for queue_name in self.queue_names.values():
+                await self.channel.declare_queue(queue_name, durable=True)
+            self.job_results_queue = await self.channel.declare_queue(self.job_results_queue_name, durable=True)
+            self.cancel_exchange = await self.channel.declare_exchange(
+                self.cancel_exchange_name,
+                aio_pika.ExchangeType.FANOUT
+            )
 
-            self.result_queue = await self.channel.declare_queue(None, exclusive=True, auto_delete=True)
+            self.result_queue = await self.channel.declare_queue(self.result_queue_name, exclusive=True, auto_delete=True)
 
             self.result_consumer_tag = await self.result_queue.consume(
                 self.on_response, 
@@ -52,15 +102,24 @@ class Publisher:
     def on_response(self, message):
         if message.correlation_id is None:
             return
+        payload = json.loads(message.body)
+
+        stream = self.result_streams.get(message.correlation_id)
+        if stream is not None:
+            stream.put_nowait(payload)
+            return
+
+        # промежуточные события нужны только потоковым запросам
+        if payload.get('event', 'result') != 'result':
+            return
         task = self.result_tasks.pop(message.correlation_id, None)
         if task is None:
             return
-        payload = json.loads(message.body)
         task.set_result(payload)
 
-    # https://stackoverflow.com/questions/50246304/using-python-decorators-to-retry-request
-    @retry(stop=stop_after_attempt(3))
-    async def send_message(self, payload):
+    # timeout - срок задачи в секундах: воркер не начнет просроченную задачу и прервет начатую,
+    # а если клиент перестал ждать раньше, задача отменяется
+    async def send_message(self, payload, timeout=None):
         await self.connect()
 
         task = self.loop.create_future()
@@ -70,35 +129,116 @@ class Publisher:
             lambda *args, **kwargs: self.result_tasks.pop(correlation_id, None)
         )
 
+        deadline = time.time() + timeout if timeout else None
+        await self.publish(payload, correlation_id, deadline=deadline)
+        
+        try:
+            return await asyncio.wait_for(task, timeout)
+        except asyncio.TimeoutError:
+            await self.cancel(correlation_id)
+            return {'event': 'result', 'result': None, 'error': 'Task expired'}
+        except asyncio.CancelledError:
+            await asyncio.shield(self.cancel(correlation_id))
+            raise
+
+    # события задачи по мере поступления: progress, image и последним - result
+    async def stream_message(self, payload, timeout=None):
+        await self.connect()
+
+        correlation_id = str(uuid.uuid4())
+        stream = self.result_streams[correlation_id] = asyncio.Queue()
+        deadline = time.time() + timeout if timeout else None
+        finished = False
+        try:
+            await self.publish({**payload, 'stream': True}, correlation_id, deadline=deadline)
+            while True:
+                try:
+                    event = await asyncio.wait_for(stream.get(), deadline - time.time() if deadline else None)
+                except asyncio.TimeoutError:
+                    event = {'event': 'result', 'result': None, 'error': 'Task expired'}
+                finished = event.get('event', 'result') == 'result'
+                yield event
+                if finished:
+                    break
+        finally:
+            self.result_streams.pop(correlation_id, None)
+            if not finished:
+                # клиент отключился или истек срок - воркеру задача больше не нужна
+                await asyncio.shield(self.cancel(correlation_id))
+
+    # https://stackoverflow.com/questions/50246304/using-python-decorators-to-retry-request
+    @retry(stop=stop_after_attempt(3))
+    async def publish(self, payload, correlation_id, reply_to=None, deadline=None):
+        await self.connect()
+
+        # https://www.rabbitmq.com/docs/ttl#per-message-ttl-in-publishers
+        # просроченное сообщение брокер выбросит сам, а срок в заголовке проверит воркер
+        headers = {}
+        expiration = None
+        if deadline is not None:
+            headers['x-deadline'] = deadline
+            expiration = max(1, deadline - time.time())
+
         # https://github.com/mosquito/aio-pika/blob/master/aio_pika/patterns/rpc.py#L365
-        await self.channel.default_exchange.publish(
-            aio_pika.Message(
-                body=json.dumps(payload, ensure_ascii=False).encode(),
-                correlation_id=correlation_id,
-                delivery_mode=aio_pika.DeliveryMode.PERSISTENT,
-                reply_to=self.result_queue.name,
-            ),
-            routing_key=self.queue_name,
+        # канал из пула нужен только на время отправки: подтверждение ждем, уже вернув канал,
+        # иначе на канале никогда не было бы больше одной неподтвержденной публикации
+        async with self.channel_pool.acquire() as channel:
+            confirmation = asyncio.ensure_future(channel.default_exchange.publish(
+                aio_pika.Message(
+                    body=json.dumps(payload, ensure_ascii=False).encode(),
+                    correlation_id=correlation_id,
+                    delivery_mode=aio_pika.DeliveryMode.PERSISTENT,
+                    reply_to=reply_to or self.result_queue.name,
+                    headers=headers,
+                    expiration=expiration,
+                ),
+                routing_key=self.queue_names[payload['task']],
+            ))
+        # aiormq сам упорядочивает одновременные публикации на канале и раздает им delivery tag
+        await confirmation
+
+    @retry(stop=stop_after_attempt(3))
+    async def cancel(self, correlation_id):
+        await self.connect()
+
+        await self.cancel_exchange.publish(
+            aio_pika.Message(body=json.dumps({'correlation_id': correlation_id}).encode()),
+            routing_key='',
         )
         
-        return await task
-        
+    # callback подтверждает сообщение сам (message.process()), после того как сохранит результат
+    async def consume_job_results(self, callback):
+        await self.connect()
+        self.job_results_consumer_tag = await self.job_results_queue.consume(callback)
+
     async def disconnect(self):
         for task in self.result_tasks.values():
             if task.done():
                 continue
             task.set_exception(Exception)
 
+        for stream in self.result_streams.values():
+            stream.put_nowait({'event': 'result', 'result': None, 'error': 'Publisher disconnected'})
+
+        if self.job_results_queue and self.job_results_consumer_tag:
+            await self.job_results_queue.cancel(self.job_results_consumer_tag)
+
         if self.result_queue and self.result_consumer_tag:
             await self.result_queue.cancel(self.result_consumer_tag)
             await self.result_queue.delete()
 
+        if self.channel_pool and not self.channel_pool.is_closed:
+            await self.channel_pool.close()
+
         if self.channel and not self.channel.is_closed:
             self.channel.close()
 
         if self.connection and not self.connection.is_closed:
             await self.connection.close()
         
+        self.channel_pool = None
+        self.job_results_consumer_tag = None
+        self.job_results_queue = None
         self.result_consumer_tag = None
         self.result_queue = None
         self.channel = None
@@ -0,0 +1,5 @@
+import pathlib
+import sys
+
+# модули API лежат плоско в api/app и импортируются по имени, как в контейнере
+sys.path.insert(0, str(pathlib.Path(__file__).parent.parent / "app"))
@@ -0,0 +1,91 @@
+import asyncio
+
+import pytest
+
+from fair_queue import FairQueue
+from jobs import JobStore, SharedSlots
+
+
+async def run_jobs(queue: FairQueue, jobs: list[tuple[str, int]]) -> list[str]:
+    order = []
+    # первая отправленная задача ждет, пока в очередь встанут все остальные
+    all_queued = asyncio.Event()
+
+    async def send(name):
+        order.append(name)
+        await all_queued.wait()
+
+    tasks = []
+    for user, cost in jobs:
+        name = f"{user}{len([job for job in tasks if job[0] == user])}"
+        tasks.append((user, asyncio.create_task(queue.run(user, cost, lambda name=name: send(name)))))
+        # задачи встают в очередь по одной, в заданном порядке
+        await asyncio.sleep(0)
+    all_queued.set()
+    await asyncio.gather(*[task for _, task in tasks])
+    return order
+
+
+def test_users_take_turns():
+    queue = FairQueue(max_in_flight=1, max_dispatched=1)
+    order = asyncio.run(run_jobs(queue, [("a", 1), ("a", 1), ("a", 1), ("b", 1), ("b", 1)]))
+    # первая задача "a" ушла сразу, дальше пользователи чередуются
+    assert order == ["a0", "b0", "a1", "b1", "a2"]
+    assert queue.stats()["users"] == {}
+
+
+def test_expensive_jobs_go_less_often():
+    queue = FairQueue(max_in_flight=1, max_dispatched=1, quantum=4)
+    order = asyncio.run(run_jobs(queue, [("big", 1), ("big", 8), ("big", 8), ("small", 1), ("small", 1), ("small", 1)]))
+    # пока у "big" копится дефицит на задачу стоимостью 8, "small" успевает отправить две задачи
+    assert order.index("big1") > order.index("small1")
+
+
+def test_cancelled_waiting_job_leaves_the_queue():
+    async def scenario():
+        queue = FairQueue(max_in_flight=1, max_dispatched=1)
+        await queue.acquire("a", 1)
+        waiting = asyncio.create_task(queue.acquire("b", 1))
+        await asyncio.sleep(0)
+        assert queue.stats()["users"]["b"]["queued"] == 1
+
+        waiting.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await waiting
+        assert "b" not in queue.stats()["users"]
+
+        # место освобождается для следующих задач, отмененная не отправляется
+        queue.release("a")
+        await asyncio.wait_for(queue.acquire("c", 1), timeout=1)
+        assert queue.stats()["users"]["c"]["in_flight"] == 1
+
+    asyncio.run(scenario())
+
+
+def test_limits_are_shared_between_processes(tmp_path):
+    async def scenario():
+        store = JobStore(tmp_path / "jobs.sqlite3")
+        # две очереди с общим учетом мест - как два процесса API
+        first, second = [
+            FairQueue(
+                max_in_flight=1,
+                max_dispatched=4,
+                slots=SharedSlots(store, "model_inference", max_in_flight=1, max_dispatched=4),
+                poll_interval=0.01,
+            )
+            for _ in range(2)
+        ]
+        await first.acquire("a", 1)
+        waiting = asyncio.create_task(second.acquire("a", 1))
+        await asyncio.sleep(0.05)
+        assert not waiting.done()
+        # другой пользователь не ждет
+        await asyncio.wait_for(second.acquire("b", 1), timeout=1)
+
+        first.release("a")
+        await asyncio.wait_for(waiting, timeout=1)
+        second.release("a")
+        second.release("b")
+        assert store.db.execute("SELECT COUNT(*) FROM slots").fetchone()[0] == 0
+
+    asyncio.run(scenario())
@@ -0,0 +1,27 @@
+from jobs import JobStore
+
+
+def test_claim_orphans_takes_queued_and_running_jobs_of_dead_owners(tmp_path):
+    store = JobStore(tmp_path / "jobs.sqlite3")
+    queued = store.create("user", {"task": "model_inference"})
+    running = store.create("user", {"task": "model_train"})
+    done = store.create("user", {"task": "model_inference"})
+    store.update(running, status="running")
+    store.update(done, status="done")
+    # владелец в старом формате host:pid - процесс до перезапуска
+    store.db.execute("UPDATE jobs SET owner = 'somehost:1'")
+
+    claimed = {job["id"]: job["status"] for job in store.claim_orphans()}
+
+    assert claimed == {queued: "queued", running: "running"}
+    assert store.get(running)["owner"] == store.owner
+    # забранные задачи второй раз не забираются
+    assert store.claim_orphans() == []
+
+
+def test_claim_orphans_skips_jobs_of_this_process(tmp_path):
+    store = JobStore(tmp_path / "jobs.sqlite3")
+    job_id = store.create("user", {"task": "model_inference"})
+    store.update(job_id, status="running")
+
+    assert store.claim_orphans() == []
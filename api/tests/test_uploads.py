@@ -0,0 +1,64 @@
+import asyncio
+import hashlib
+import io
+
+from fastapi import FastAPI, UploadFile
+from fastapi.testclient import TestClient
+
+from blobs import BlobStore
+from uploads import UploadSizeLimitMiddleware, save_uploads
+
+
+def make_upload(data: bytes, filename: str = "photo.jpg") -> UploadFile:
+    return UploadFile(file=io.BytesIO(data), filename=filename, size=len(data))
+
+
+def test_reupload_of_same_bytes_writes_nothing(tmp_path, monkeypatch):
+    blobs = BlobStore(tmp_path / "blobs")
+    data = b"same photo" * 1000
+
+    image_hashes = asyncio.run(save_uploads([make_upload(data)], tmp_path / "first" / "data", blobs))
+    (digest,) = image_hashes.values()
+    assert blobs.refcount(digest) == 1
+
+    # каждый временный файл хранилища берется через tmp_path
+    tmp_paths = []
+    original_tmp_path = blobs.tmp_path
+
+    def recording_tmp_path():
+        tmp_paths.append(original_tmp_path())
+        return tmp_paths[-1]
+
+    monkeypatch.setattr(blobs, "tmp_path", recording_tmp_path)
+
+    asyncio.run(save_uploads([make_upload(data)], tmp_path / "second" / "data", blobs))
+
+    assert tmp_paths == []
+    assert list(blobs.tmp_dir.iterdir()) == []
+    assert blobs.refcount(digest) == 2
+
+
+def test_upload_size_limit_rejects_by_content_length():
+    app = FastAPI()
+    app.add_middleware(UploadSizeLimitMiddleware, max_bytes=1024)
+
+    @app.post("/upload/")
+    async def upload(files: list[UploadFile]):
+        return {"files": len(files)}
+
+    client = TestClient(app)
+    assert client.post("/upload/", files=[("files", ("a.jpg", b"x" * 100))]).status_code == 200
+    assert client.post("/upload/", files=[("files", ("a.jpg", b"x" * 4096))]).status_code == 413
+
+
+def test_image_names_keep_upload_order(tmp_path):
+    blobs = BlobStore(tmp_path / "blobs")
+    uploads = [make_upload(f"photo {i}".encode()) for i in (3, 1, 2)]
+
+    image_hashes = asyncio.run(save_uploads(uploads, tmp_path / "user" / "data", blobs))
+
+    names = sorted(path.name for path in (tmp_path / "user" / "data").iterdir())
+    assert names == list(image_hashes)
+    assert [image_hashes[name] for name in names] == [
+        hashlib.sha256(f"photo {i}".encode()).hexdigest() for i in (3, 1, 2)
+    ]
@@ -1,8 +1,6 @@
 #https://colab.research.google.com/github/huggingface/notebooks/blob/main/diffusers/controlnet.ipynb#scrollTo=wsv55Py8onJx
 import glob
-import os
 import pathlib
-from datetime import datetime
 
 import cv2
 import numpy as np
@@ -12,6 +10,9 @@ from diffusers import (ControlNetModel, StableDiffusionControlNetPipeline,
 from diffusers.utils import load_image
 from PIL import Image
 
+from encoding import OutputEncoder, wait_saved
+from generation import generate_images, make_result_dir
+
 
 class ControlNet():
     def __init__(self, model_dir: str, cache_dir: str, prompt: str):
@@ -27,7 +28,9 @@ class ControlNet():
         images_list = glob.glob(f"{self.image_dir}/*.jpg")
         if not images_list:
             raise ValueError(f"Missing images in path: {self.image_dir}")
-        images_list.sort(key=os.path.getmtime)
+        # фото - жесткие ссылки на общее хранилище, их mtime не говорит о порядке загрузки;
+        # API нумерует фото в порядке загрузки в начале имени
+        images_list.sort(key=lambda path: pathlib.Path(path).name)
         # print (images_list)
         image = load_image(images_list[-1])
 
@@ -63,32 +66,40 @@ class ControlNet():
 
         self.pipe.enable_model_cpu_offload()
 
-    # генерация картинки
-    def generate(self):
+    # генерация картинки;
+    # on_image(path) вызывается для каждой картинки сразу после сохранения
+    def generate(self, encoder: OutputEncoder, num_images: int = 4, batch_size: int | None = None, on_image=None, should_stop=None):
 
-        now = datetime.now()
-        date_time = now.strftime("%Y_%m_%d_%H_%M_%S")
-        
-        result_dir = pathlib.Path(self.model_dir) / f'result/{date_time}'
-        result_dir.mkdir(parents=True, exist_ok=True)
+        result_dir = make_result_dir(self.model_dir)
 
+        seeds = list(range(num_images))
         result = []
+        result_images = []
+        saved = []
+
+        def save_images(start, images):
+            for seed, image in zip(seeds[start:], images):
+                path_to_save = result_dir / f'tatto{seed}{encoder.extension}' 
+                result.append(path_to_save)
+                result_images.append(image)
+                saved.append(encoder.submit(image, path_to_save, on_saved=on_image))
+
+        generate_images(
+            self.pipe,
+            seeds=seeds,
+            device="cpu",
+            chunk_size=batch_size,
+            first_chunk_size=1 if on_image is not None else None,
+            on_images=save_images,
+            should_stop=should_stop,
+            prompt=self.prompt,
+            image=self.image,
+            negative_prompt= "bad anatomy, worst quality, low quality",
+            num_inference_steps=20,
+        )
 
-        for seed in range(4):
-            generator = torch.Generator(device="cpu").manual_seed(seed)
-
-            image = self.pipe(
-                self.prompt,
-                self.image,
-                negative_prompt= "bad anatomy, worst quality, low quality",
-                generator=generator,
-                num_inference_steps=20,
-            )
-
-            image = image.images[0]
-
-            path_to_save = result_dir / f'tatto{seed}.png' 
-            image.save(path_to_save)
-            result.append(path_to_save)        
+        if len(result_images) > 1:
+            saved.append(encoder.submit_contact_sheet(result_images, result_dir))
+        wait_saved(saved)
 
         return result
@@ -1,21 +1,29 @@
 #https://github.com/huggingface/notebooks/blob/main/diffusers/SDXL_DreamBooth_LoRA_.ipynb
 #https://medium.com/@dminhk/how-to-fine-tune-dreambooth-lora-for-stable-diffusion-xl-sdxl-in-amazon-sagemaker-notebook-7ce6726ebca9
-import gc
 import glob
 import json
-import locale
 import os
 import pathlib
-from datetime import datetime
 
 import torch
-from diffusers import AutoencoderKL, DiffusionPipeline
-from PIL import Image
-from transformers import AutoProcessor, BlipForConditionalGeneration
+
+import train_dreambooth_lora_sdxl
+from adapters import BASE_MODEL, VAE_MODEL
+from cancellation import TaskCancelled
+from disk_cache import prune_cache
+from encoding import OutputEncoder, wait_saved
+from generation import generate_images, make_result_dir
+
+# предельный размер кэша латентов фотографий (~256 КБ на фото и разрешение); сверх него
+# перед обучением удаляются латенты, которые дольше всех не использовались
+LATENTS_CACHE_MAX_BYTES = int(os.environ.get('LATENTS_CACHE_MAX_BYTES', 2 * 1024**3))
 
 
 class DreamBoth_LoRA():
-    def __init__(self,  model_dir: str, cache_dir: str, prompt: str, type_person :str):
+    # resolution_schedule - этапы обучения "разрешение:доля шагов", например "512:0.4,1024:0.6":
+    # грубые черты лица учатся на маленьком разрешении, детали - на полном;
+    # image_hashes - {имя файла: sha256} от API, чтобы не хэшировать фото повторно
+    def __init__(self,  model_dir: str, cache_dir: str, prompt: str, type_person :str, resolution_schedule: str | None = None, image_hashes: dict | None = None):
         self.model_dir = pathlib.Path(model_dir)
         self.image_dir = pathlib.Path(model_dir) / "data"
         self.output_dir = pathlib.Path(model_dir) / "weight"
@@ -23,124 +31,128 @@ class DreamBoth_LoRA():
         self.device = "cuda" if torch.cuda.is_available() else "cpu" 
         self.type_person = type_person 
         self.prompt = f'Super realistic photo of (((SOK))) {self.type_person} with {prompt}'
+        self.resolution_schedule = resolution_schedule
+        self.image_hashes = image_hashes or {}
         
 
-    # captioning utility
-    def caption_images(self, input_image):    
-        # load the processor and the captioning model
-        self.blip_processor = AutoProcessor.from_pretrained(
-            "Salesforce/blip-image-captioning-base", 
-            cache_dir=self.cache_dir
-        )
-        self.blip_model = BlipForConditionalGeneration.from_pretrained(
-            "Salesforce/blip-image-captioning-base",
-            torch_dtype=torch.float16,
-            cache_dir=self.cache_dir
-        ).to(self.device) 
-
-        inputs = self.blip_processor(images=input_image, return_tensors="pt").to(self.device, torch.float16)
-        pixel_values = inputs.pixel_values
-
-        generated_ids = self.blip_model.generate(pixel_values=pixel_values, max_length=50)
-        generated_caption = self.blip_processor.batch_decode(generated_ids, skip_special_tokens=True)[0]
-        return generated_caption
-    
-    def train(self):
-        # create a list of (Pil.Image, path) pairs 
-        imgs_and_paths = [(path,Image.open(path)) for path in glob.glob(f"{self.image_dir}/*.jpg")]
+    # on_progress(step, total) вызывается после каждого шага обучения,
+    # should_stop() проверяется перед каждым шагом
+    def train(self, captioner, lora_pipeline, on_progress=None, should_stop=None):
+        image_paths = sorted(glob.glob(f"{self.image_dir}/*.jpg"))
 
         caption_prefix = f"a photo of SOK {self.type_person}, " #@param
 
+        # подписываем одним батчем только фотографии, которых нет в кэше
+        hashes = [self.image_hashes.get(pathlib.Path(path).name) for path in image_paths]
+        captions, caption_stats = captioner.caption_files(image_paths, hashes=hashes)
+
         json_path = self.image_dir / 'metadata.jsonl'
         json_path.unlink(missing_ok=True)
 
         with open(str(json_path), 'w') as outfile:
-            for img in imgs_and_paths:
-                caption = caption_prefix + self.caption_images(img[1]).split("\n")[0]
-                entry = {"file_name":img[0].split("/")[-1], "prompt": caption}
+            for path, caption in zip(image_paths, captions):
+                entry = {"file_name": pathlib.Path(path).name, "prompt": caption_prefix + caption}
                 json.dump(entry, outfile)
                 outfile.write('\n')
 
-        # delete the BLIP pipelines and free up some memory
-        self.blip_processor = None, 
-        self.blip_model = None
-        gc.collect()
-        torch.cuda.empty_cache()
-
-        locale.getpreferredencoding = lambda: "UTF-8"
-
-        command = ('accelerate config default')
-        os.system(command)
-
         self.output_dir.mkdir(exist_ok=True)
+        prune_cache(self.cache_dir / "latents", LATENTS_CACHE_MAX_BYTES, "*.safetensors")
 
-    # !accelerate config default
         instance_prompt = f'a photo of SOK {self.type_person}'
-        max_train_steps = 500
-
-        #!/usr/bin/env bash
-        command = (f'accelerate launch train_dreambooth_lora_sdxl.py '
-        f'--pretrained_model_name_or_path="stabilityai/stable-diffusion-xl-base-1.0" '
-        f'--pretrained_vae_model_name_or_path="madebyollin/sdxl-vae-fp16-fix" '
-        f'--dataset_name="{self.image_dir}" '
-        f'--output_dir="{self.output_dir}" '
-        f'--caption_column="prompt" '
-        f'--mixed_precision="fp16" '
-        f'--instance_prompt="{instance_prompt}" '
-        f'--resolution=1024 '
-        f'--train_batch_size=1 '
-        f'--gradient_accumulation_steps=3 '
-        f'--gradient_checkpointing '
-        f'--learning_rate=1e-4 '
-        f'--snr_gamma=5.0 '
-        f'--lr_scheduler="constant" '
-        f'--lr_warmup_steps=0 '
-        f'--mixed_precision="fp16" '
-        f'--use_8bit_adam '
-        f'--max_train_steps={max_train_steps} '
-        f'--checkpointing_steps=717 '
-        f'--seed="0" '
-        f'--cache_dir="{self.cache_dir}" ')
-
-        os.system(command)
-
-    def inference(self):
-        # sdxl-lora-inference-base.py
-        AutoencoderKL.from_pretrained(
-            "madebyollin/sdxl-vae-fp16-fix", 
-            torch_dtype=torch.float16,
-            cache_dir=self.cache_dir
-        )
 
-        pipe = DiffusionPipeline.from_pretrained(
-            "stabilityai/stable-diffusion-xl-base-1.0",
-            torch_dtype=torch.float16,
-            variant="fp16",
-            use_safetensors=True,
-            cache_dir=self.cache_dir
+        config = train_dreambooth_lora_sdxl.TrainConfig(
+            pretrained_model_name_or_path=BASE_MODEL,
+            pretrained_vae_model_name_or_path=VAE_MODEL,
+            dataset_name=str(self.image_dir),
+            output_dir=str(self.output_dir),
+            caption_column="prompt",
+            mixed_precision="fp16",
+            instance_prompt=instance_prompt,
+            resolution=1024,
+            resolution_schedule=self.resolution_schedule,
+            train_batch_size=1,
+            gradient_accumulation_steps=3,
+            gradient_checkpointing=True,
+            learning_rate=1e-4,
+            snr_gamma=5.0,
+            lr_scheduler="constant",
+            lr_warmup_steps=0,
+            use_8bit_adam=True,
+            # число шагов зависит от количества фотографий (не меньше 200 и не больше 500),
+            # обучение заканчивается раньше, если сглаженный loss перестал уменьшаться
+            max_train_steps=500,
+            max_train_steps_per_image=50,
+            min_train_steps=200,
+            early_stopping_patience=60,
+            early_stopping_min_delta=0.01,
+            checkpointing_steps=717,
+            seed=0,
+            cache_dir=str(self.cache_dir),
+            # фотографии хранятся один раз в uint8, кроп и нормализация - при чтении
+            lazy_dataset=True,
+            # латенты фотографий считаются VAE один раз и переиспользуются между запусками
+            cache_latents=True,
+            latents_cache_dir=str(self.cache_dir / "latents"),
         )
-        pipe = pipe.to("cuda")
-        pipe.load_lora_weights(
-            self.output_dir, 
-            weight_name="pytorch_lora_weights.safetensors"
+
+        # обучаем в этом же процессе на модулях уже загруженного пайплайна,
+        # базовая модель второй раз с диска не читается
+        train_result = train_dreambooth_lora_sdxl.main(
+            config.to_args(),
+            components=lora_pipeline.training_components(adapter_name=self.model_dir.name),
+            on_progress=on_progress,
+            should_stop=should_stop
         )
+        if train_result["stop_reason"] == "cancelled":
+            raise TaskCancelled("Task cancelled")
+
+        # время каждого этапа - чтобы сравнивать расписания между собой
+        return {
+            "captions": caption_stats,
+            "steps": train_result["steps"],
+            "max_train_steps": train_result["max_train_steps"],
+            "stop_reason": train_result["stop_reason"],
+            "stages": train_result["stages"],
+        }
+
+    # on_image(path) вызывается для каждой картинки сразу после сохранения (оригинала и вариантов для доставки),
+    # рядом с картинками кладется сетка всех картинок запроса
+    def inference(self, lora_pipeline, encoder: OutputEncoder, num_images: int = 4, batch_size: int | None = None, num_inference_steps: int = 25, on_image=None, should_stop=None, **pipe_kwargs) -> list[pathlib.Path]:
+        # базовый пайплайн уже загружен, подключаем только адаптер пользователя
+        pipe = lora_pipeline.activate(self.output_dir, adapter_name=self.model_dir.name)
 
         # SDXL styles: enhance, anime, photographic, digital-art, comic-book, fantasy-art, line-art, analog-film, neon-punk, isometric, low-poly, origami, modeling-compound, cinematic, 3d-mode, pixel-art, and tile-texture
         #prompt = "real photo of SOK women with geometric style tattoo design of a tree composed entirely of intersecting triangles and polygons on shoulder"
-        now = datetime.now()
-        date_time = now.strftime("%Y_%m_%d_%H_%M_%S")
-        
-        result_dir = pathlib.Path(self.model_dir) / f'result/{date_time}'
-        result_dir.mkdir(parents=True, exist_ok=True)
-
+        result_dir = make_result_dir(self.model_dir)
+        seeds = list(range(num_images))
         result = []
-        for seed in range(4):
-            generator = torch.Generator("cuda").manual_seed(seed)
-            image = pipe(prompt=self.prompt, generator=generator, num_inference_steps=25)
-            image = image.images[0]
-
-            path_to_save = result_dir / f'tatto{seed}.png' 
-            image.save(path_to_save)
-            result.append(path_to_save)
-        
+        images = []
+        saved = []
+
+        # картинки кодируются в фоне по мере генерации, не дожидаясь остальных
+        def save_images(start, chunk_images):
+            for seed, image in zip(seeds[start:], chunk_images):
+                path_to_save = result_dir / f'tatto{seed}{encoder.extension}' 
+                result.append(path_to_save)
+                images.append(image)
+                saved.append(encoder.submit(image, path_to_save, on_saved=on_image))
+
+        generate_images(
+            pipe,
+            seeds=seeds,
+            device=self.device,
+            chunk_size=batch_size,
+            first_chunk_size=1 if on_image is not None else None,
+            on_images=save_images,
+            should_stop=should_stop,
+            prompt=self.prompt,
+            num_inference_steps=num_inference_steps,
+            **pipe_kwargs
+        )
+
+        if len(images) > 1:
+            saved.append(encoder.submit_contact_sheet(images, result_dir))
+        # в ответе только уже записанные файлы
+        wait_saved(saved)
+
         return result
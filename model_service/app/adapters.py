@@ -0,0 +1,93 @@
+#https://huggingface.co/docs/diffusers/tutorials/using_peft_for_inference
+import pathlib
+from collections import OrderedDict
+
+import torch
+from diffusers import AutoencoderKL, DiffusionPipeline
+
+BASE_MODEL = "stabilityai/stable-diffusion-xl-base-1.0"
+VAE_MODEL = "madebyollin/sdxl-vae-fp16-fix"
+LORA_WEIGHT_NAME = "pytorch_lora_weights.safetensors"
+
+
+class LoraPipeline():
+    # один базовый SDXL пайплайн на весь процесс,
+    # LoRA адаптеры пользователей подгружаются в него и вытесняются по LRU
+    def __init__(self, cache_dir: str, max_adapters: int = 8, max_bytes: int = 2 * 1024**3):
+        self.cache_dir = pathlib.Path(cache_dir)
+        self.device = "cuda" if torch.cuda.is_available() else "cpu"
+        self.max_adapters = max_adapters
+        self.max_bytes = max_bytes
+
+        self.pipe = None
+        # adapter_name -> (weight_path, mtime, size), порядок = порядок использования
+        self.adapters = OrderedDict()
+
+    def get_pipe(self):
+        if self.pipe is None:
+            vae = AutoencoderKL.from_pretrained(
+                VAE_MODEL,
+                torch_dtype=torch.float16,
+                cache_dir=self.cache_dir
+            )
+            self.pipe = DiffusionPipeline.from_pretrained(
+                BASE_MODEL,
+                vae=vae,
+                torch_dtype=torch.float16,
+                variant="fp16",
+                use_safetensors=True,
+                cache_dir=self.cache_dir
+            )
+            self.pipe = self.pipe.to(self.device)
+        return self.pipe
+
+    # модули базовой модели для обучения в этом же процессе; обучение добавляет в UNet свой адаптер "default",
+    # делает активным только его и обучает только его параметры, так что адаптеры других пользователей
+    # остаются в кэше; выгружается только адаптер adapter_name, который сейчас переобучается - его веса устареют
+    def training_components(self, adapter_name: str | None = None) -> dict:
+        if adapter_name is not None:
+            self.evict(adapter_name)
+        return self.get_pipe().components
+
+    def used_bytes(self) -> int:
+        return sum(size for _, _, size in self.adapters.values())
+
+    def activate(self, weight_dir: str, adapter_name: str):
+        pipe = self.get_pipe()
+        weight_path = pathlib.Path(weight_dir) / LORA_WEIGHT_NAME
+        if not weight_path.exists():
+            raise ValueError(f"Missing LoRA weights in path: {weight_path}")
+        stat = weight_path.stat()
+
+        cached = self.adapters.get(adapter_name)
+        # после переобучения файл с весами меняется, старый адаптер выгружаем
+        if cached and cached[:2] != (weight_path, stat.st_mtime):
+            self.evict(adapter_name)
+            cached = None
+
+        if cached:
+            self.adapters.move_to_end(adapter_name)
+        else:
+            while self.adapters and (
+                len(self.adapters) >= self.max_adapters
+                or self.used_bytes() + stat.st_size > self.max_bytes
+            ):
+                self.evict(next(iter(self.adapters)))
+
+            pipe.load_lora_weights(
+                weight_path.parent,
+                weight_name=weight_path.name,
+                adapter_name=adapter_name
+            )
+            self.adapters[adapter_name] = (weight_path, stat.st_mtime, stat.st_size)
+
+        pipe.set_adapters([adapter_name])
+        return pipe
+
+    def evict(self, adapter_name: str):
+        if self.adapters.pop(adapter_name, None) is not None:
+            self.pipe.delete_adapters(adapter_name)
+
+    def clear(self):
+        for adapter_name in list(self.adapters):
+            self.evict(adapter_name)
@@ -0,0 +1,39 @@
+#https://huggingface.co/docs/diffusers/using-diffusers/callback
+import time
+
+
+class TaskCancelled(Exception):
+    pass
+
+
+class CancelToken():
+    # задача отменена клиентом (сообщение в exchange cancel) или истек ее срок;
+    # проверяется перед запуском и между шагами денойзинга и обучения
+    def __init__(self, cancelled_ids, correlation_id: str | None = None, deadline: float | None = None):
+        self.cancelled_ids = cancelled_ids
+        self.correlation_id = correlation_id
+        self.deadline = deadline
+
+    def reason(self) -> str | None:
+        if self.correlation_id is not None and self.correlation_id in self.cancelled_ids:
+            return 'cancelled'
+        if self.deadline is not None and time.time() > self.deadline:
+            return 'expired'
+        return None
+
+    def __call__(self) -> bool:
+        return self.reason() is not None
+
+    def check(self):
+        reason = self.reason()
+        if reason is not None:
+            raise TaskCancelled(f"Task {reason}")
+
+
+# прерывает генерацию на ближайшем шаге, не дожидаясь оставшихся шагов и декодирования VAE
+def stop_callback(should_stop):
+    def callback_on_step_end(pipe, step, timestep, callback_kwargs):
+        if should_stop():
+            raise TaskCancelled("Task cancelled")
+        return callback_kwargs
+    return callback_on_step_end
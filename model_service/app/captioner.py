@@ -0,0 +1,121 @@
+#https://huggingface.co/docs/transformers/model_doc/blip#transformers.BlipForConditionalGeneration
+import gc
+import hashlib
+import json
+import os
+import pathlib
+
+import torch
+from PIL import Image
+from transformers import AutoProcessor, BlipForConditionalGeneration
+
+from disk_cache import prune_cache, touch
+
+CAPTION_MODEL = "Salesforce/blip-image-captioning-base"
+# предельный размер кэша подписей; сверх него удаляются подписи, которые дольше всех не использовались
+CAPTION_CACHE_MAX_BYTES = int(os.environ.get('CAPTION_CACHE_MAX_BYTES', 64 * 1024**2))
+
+
+class Captioner():
+    # BLIP загружается один раз на воркер и лежит в памяти процесса,
+    # на видеокарту переезжает только на время подписывания картинок
+    def __init__(self, cache_dir: str, model_id: str = CAPTION_MODEL, max_length: int = 50, max_cache_bytes: int = CAPTION_CACHE_MAX_BYTES):
+        self.cache_dir = pathlib.Path(cache_dir)
+        self.max_cache_bytes = max_cache_bytes
+        self.device = "cuda" if torch.cuda.is_available() else "cpu"
+        self.model_id = model_id
+        self.max_length = max_length
+
+        self.processor = None
+        self.model = None
+
+    def load(self):
+        if self.model is None:
+            self.processor = AutoProcessor.from_pretrained(
+                self.model_id,
+                cache_dir=self.cache_dir
+            )
+            self.model = BlipForConditionalGeneration.from_pretrained(
+                self.model_id,
+                torch_dtype=torch.float16,
+                cache_dir=self.cache_dir
+            )
+
+    # подписи берутся из кэша по хэшу содержимого картинки,
+    # через BLIP проходят только картинки, которых еще не было;
+    # hashes - уже известные sha256 файлов (None - посчитать по файлу)
+    def caption_files(self, paths: list[str], hashes: list[str | None] | None = None) -> tuple[list[str], dict[str, int]]:
+        hashes = hashes or [None] * len(paths)
+        keys = [self.cache_key(image_hash or file_hash(path)) for path, image_hash in zip(paths, hashes)]
+        captions = [self.cache_get(key) for key in keys]
+
+        missing = [i for i, caption in enumerate(captions) if caption is None]
+        if missing:
+            images = [Image.open(paths[i]).convert("RGB") for i in missing]
+            new_captions = self.caption(images)
+            for image in images:
+                image.close()
+
+            for i, caption in zip(missing, new_captions):
+                captions[i] = caption
+                self.cache_set(keys[i], caption)
+            prune_cache(self.cache_dir / "captions", self.max_cache_bytes, "*.json")
+
+        stats = {"hits": len(paths) - len(missing), "misses": len(missing)}
+        return captions, stats
+
+    # ключ учитывает модель и настройки генерации, а не только картинку
+    def cache_key(self, image_hash: str) -> str:
+        settings = f"{image_hash}:{self.model_id}:max_length={self.max_length}"
+        return hashlib.sha256(settings.encode()).hexdigest()
+
+    def cache_path(self, key: str) -> pathlib.Path:
+        return self.cache_dir / "captions" / key[:2] / f"{key}.json"
+
+    def cache_get(self, key: str) -> str | None:
+        try:
+            with open(self.cache_path(key)) as f:
+                caption = json.load(f)["caption"]
+        except (OSError, ValueError, KeyError):
+            return None
+        touch(self.cache_path(key))
+        return caption
+
+    def cache_set(self, key: str, caption: str):
+        path = self.cache_path(key)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        # пишем во временный файл и переименовываем, чтобы не оставить битую запись
+        tmp_path = path.with_suffix(f".{os.getpid()}.tmp")
+        with open(tmp_path, "w") as f:
+            json.dump({"caption": caption}, f, ensure_ascii=False)
+        os.replace(tmp_path, path)
+
+    # все картинки задачи проходят через один вызов generate
+    def caption(self, images: list) -> list[str]:
+        if not images:
+            return []
+
+        self.load()
+        self.model.to(self.device)
+        try:
+            inputs = self.processor(images=images, return_tensors="pt").to(self.device, torch.float16)
+            with torch.no_grad():
+                generated_ids = self.model.generate(pixel_values=inputs.pixel_values, max_length=self.max_length)
+            captions = self.processor.batch_decode(generated_ids, skip_special_tokens=True)
+        finally:
+            # освобождаем видеопамять сразу, не дожидаясь сборщика мусора
+            inputs = generated_ids = None
+            self.model.to("cpu")
+            gc.collect()
+            if torch.cuda.is_available():
+                torch.cuda.empty_cache()
+
+        return [caption.split("\n")[0] for caption in captions]
+
+
+def file_hash(path: str) -> str:
+    sha256 = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b""):
+            sha256.update(chunk)
+    return sha256.hexdigest()
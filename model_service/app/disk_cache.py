@@ -0,0 +1,38 @@
+# https://docs.python.org/3/library/os.html#os.scandir
+import os
+import pathlib
+
+
+# оставляет в папке кэша не больше max_bytes: удаляются файлы, которые дольше всех не использовались;
+# при попадании в кэш файл "трогается" (touch), поэтому mtime - время последнего использования
+def prune_cache(directory: str, max_bytes: int, pattern: str = "*") -> int:
+    directory = pathlib.Path(directory)
+    if not directory.exists():
+        return 0
+
+    files = []
+    for path in directory.rglob(pattern):
+        try:
+            stat = path.stat()
+        except FileNotFoundError:
+            continue
+        if path.is_file():
+            files.append((stat.st_mtime, stat.st_size, path))
+
+    total = sum(size for _, size, _ in files)
+    removed = 0
+    for _, size, path in sorted(files, key=lambda file: file[0]):
+        if total <= max_bytes:
+            break
+        # запись мог одновременно удалить другой процесс
+        path.unlink(missing_ok=True)
+        total -= size
+        removed += 1
+    return removed
+
+
+def touch(path: pathlib.Path):
+    try:
+        os.utime(path)
+    except OSError:
+        pass
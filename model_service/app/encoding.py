@@ -0,0 +1,102 @@
+#https://pillow.readthedocs.io/en/stable/handbook/image-file-formats.html
+import math
+import os
+import pathlib
+from concurrent.futures import Future, ThreadPoolExecutor
+
+from PIL import Image
+
+# формат оригинала: png, webp или jpeg
+OUTPUT_FORMAT = os.environ.get('OUTPUT_FORMAT', 'png').lower()
+# у PIL по умолчанию 6; 1 сжимает в разы быстрее, а файл больше всего на 10-20%
+OUTPUT_PNG_COMPRESS_LEVEL = int(os.environ.get('OUTPUT_PNG_COMPRESS_LEVEL', 1))
+# качество для jpeg и webp с потерями
+OUTPUT_QUALITY = int(os.environ.get('OUTPUT_QUALITY', 90))
+OUTPUT_WEBP_LOSSLESS = os.environ.get('OUTPUT_WEBP_LOSSLESS', '0') == '1'
+OUTPUT_ENCODER_WORKERS = int(os.environ.get('OUTPUT_ENCODER_WORKERS', 2))
+
+# Telegram все равно пережимает фото в jpeg не больше 1280 по длинной стороне,
+# поэтому боту отдаем сразу такой вариант
+TELEGRAM_MAX_SIDE = 1280
+TELEGRAM_QUALITY = 85
+CONTACT_SHEET_TILE = 384
+
+# варианты лежат рядом с оригиналом: tatto0.png -> tatto0.telegram.jpg, API находит их по этим именам
+VARIANT_SUFFIXES = {"telegram": ".telegram.jpg"}
+# все картинки запроса одной сеткой, в папке результата
+CONTACT_SHEET_NAME = "contact_sheet.jpg"
+
+EXTENSIONS = {"png": ".png", "webp": ".webp", "jpeg": ".jpg"}
+
+
+class OutputEncoder():
+    # кодирование картинок идет в отдельных потоках (кодеки PIL отпускают GIL),
+    # так что пока сохраняется одна картинка, видеокарта уже считает следующую
+    def __init__(self, format: str = OUTPUT_FORMAT, png_compress_level: int = OUTPUT_PNG_COMPRESS_LEVEL, quality: int = OUTPUT_QUALITY, webp_lossless: bool = OUTPUT_WEBP_LOSSLESS, workers: int = OUTPUT_ENCODER_WORKERS):
+        if format not in EXTENSIONS:
+            raise ValueError(f"Unknown output format: {format}")
+        self.format = format
+        self.png_compress_level = png_compress_level
+        self.quality = quality
+        self.webp_lossless = webp_lossless
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="encoder")
+
+    @property
+    def extension(self) -> str:
+        return EXTENSIONS[self.format]
+
+    def save_options(self) -> dict:
+        if self.format == "png":
+            return {"compress_level": self.png_compress_level}
+        if self.format == "webp":
+            return {"lossless": self.webp_lossless, "quality": self.quality, "method": 4}
+        return {"quality": self.quality}
+
+    # оригинал и все его варианты
+    def save(self, image: Image.Image, path: pathlib.Path) -> pathlib.Path:
+        image.save(path, format=self.format.upper(), **self.save_options())
+
+        telegram_image = image.convert("RGB")
+        telegram_image.thumbnail((TELEGRAM_MAX_SIDE, TELEGRAM_MAX_SIDE))
+        telegram_image.save(variant_path(path, "telegram"), format="JPEG", quality=TELEGRAM_QUALITY, optimize=True)
+        return path
+
+    # on_saved(path) вызывается из потока кодировщика, когда оригинал и варианты записаны
+    def submit(self, image: Image.Image, path: pathlib.Path, on_saved=None) -> Future:
+        future = self.executor.submit(self.save, image, path)
+        if on_saved is not None:
+            future.add_done_callback(lambda f: f.exception() is None and on_saved(path))
+        return future
+
+    def save_contact_sheet(self, images: list, result_dir: pathlib.Path) -> pathlib.Path:
+        columns = math.ceil(math.sqrt(len(images)))
+        rows = math.ceil(len(images) / columns)
+        sheet = Image.new("RGB", (columns * CONTACT_SHEET_TILE, rows * CONTACT_SHEET_TILE), "white")
+        for i, image in enumerate(images):
+            tile = image.convert("RGB")
+            tile.thumbnail((CONTACT_SHEET_TILE, CONTACT_SHEET_TILE))
+            x = (i % columns) * CONTACT_SHEET_TILE + (CONTACT_SHEET_TILE - tile.width) // 2
+            y = (i // columns) * CONTACT_SHEET_TILE + (CONTACT_SHEET_TILE - tile.height) // 2
+            sheet.paste(tile, (x, y))
+
+        path = result_dir / CONTACT_SHEET_NAME
+        sheet.save(path, format="JPEG", quality=TELEGRAM_QUALITY, optimize=True)
+        return path
+
+    def submit_contact_sheet(self, images: list, result_dir: pathlib.Path) -> Future:
+        return self.executor.submit(self.save_contact_sheet, images, result_dir)
+
+    # дожидается записи всех поставленных картинок
+    def close(self):
+        self.executor.shutdown(wait=True)
+
+
+def variant_path(path: pathlib.Path, variant: str) -> pathlib.Path:
+    return path.with_name(f"{path.stem}{VARIANT_SUFFIXES[variant]}")
+
+
+# дожидается записи всех картинок; ошибка кодирования становится ошибкой задачи
+def wait_saved(futures: list[Future]):
+    for future in futures:
+        future.result()
+
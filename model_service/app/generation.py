@@ -0,0 +1,65 @@
+#https://huggingface.co/docs/diffusers/using-diffusers/reusing_seeds
+import pathlib
+from datetime import datetime
+
+import torch
+
+from cancellation import TaskCancelled, stop_callback
+
+
+# генерируем картинки для всех сидов одним вызовом пайплайна,
+# при нехватке видеопамяти делим на части поменьше;
+# on_images(start, images) вызывается после каждой части - картинки можно отдавать, не дожидаясь остальных,
+# first_chunk_size=1 - первая картинка готова за время одной генерации, остальные идут батчем;
+# should_stop() проверяется на каждом шаге денойзинга - отмененная задача сразу освобождает видеокарту
+def generate_images(pipe, seeds: list[int], device: str, chunk_size: int | None = None, first_chunk_size: int | None = None, on_images=None, should_stop=None, **pipe_kwargs) -> list:
+    chunk_size = min(chunk_size or len(seeds), len(seeds))
+    if should_stop is not None:
+        pipe_kwargs["callback_on_step_end"] = stop_callback(should_stop)
+
+    images = []
+    while len(images) < len(seeds):
+        start = len(images)
+        size = min(first_chunk_size, chunk_size) if start == 0 and first_chunk_size else chunk_size
+        chunk = seeds[start:start + size]
+        # отдельный генератор на каждый сид - картинка та же, что и при генерации по одной
+        generators = [torch.Generator(device).manual_seed(seed) for seed in chunk]
+
+        try:
+            output = pipe(
+                generator=generators,
+                # один промт на все картинки - текстовые энкодеры считаются один раз
+                num_images_per_prompt=len(chunk),
+                **pipe_kwargs
+            )
+        except TaskCancelled:
+            if torch.cuda.is_available():
+                torch.cuda.empty_cache()
+            raise
+        except torch.cuda.OutOfMemoryError:
+            if len(chunk) == 1:
+                raise
+            torch.cuda.empty_cache()
+            chunk_size = max(1, len(chunk) // 2)
+            first_chunk_size = None
+            continue
+
+        images.extend(output.images)
+        if on_images is not None:
+            on_images(start, output.images)
+
+    return images
+
+
+def make_result_dir(model_dir: str) -> pathlib.Path:
+    now = datetime.now()
+    date_time = now.strftime("%Y_%m_%d_%H_%M_%S")
+
+    # несколько запросов одного пользователя могут завершиться в одну секунду
+    result_dir = pathlib.Path(model_dir) / f'result/{date_time}'
+    suffix = 0
+    while result_dir.exists():
+        suffix += 1
+        result_dir = pathlib.Path(model_dir) / f'result/{date_time}_{suffix}'
+    result_dir.mkdir(parents=True)
+    return result_dir
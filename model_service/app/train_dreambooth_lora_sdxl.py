@@ -15,6 +15,7 @@
 
 import argparse
 import gc
+import hashlib
 import itertools
 import json
 import logging
@@ -22,8 +23,11 @@ import math
 import os
 import random
 import shutil
+import tempfile
+import time
 import warnings
 from contextlib import nullcontext
+from dataclasses import dataclass, field, fields
 from pathlib import Path
 
 import diffusers
@@ -35,12 +39,14 @@ import transformers
 from accelerate import Accelerator
 from accelerate.logging import get_logger
 from accelerate.utils import (DistributedDataParallelKwargs,
-                              ProjectConfiguration, set_seed)
+                              ProjectConfiguration,
+                              extract_model_from_parallel, set_seed)
 from diffusers import (AutoencoderKL, DDPMScheduler,
                        DPMSolverMultistepScheduler, EDMEulerScheduler,
                        EulerDiscreteScheduler, StableDiffusionXLPipeline,
                        UNet2DConditionModel)
 from diffusers.loaders import LoraLoaderMixin
+from diffusers.models.autoencoders.vae import DiagonalGaussianDistribution
 from diffusers.optimization import get_scheduler
 from diffusers.training_utils import (_set_state_dict_into_text_encoder,
                                       cast_training_params, compute_snr)
@@ -659,21 +665,116 @@ def parse_args(input_args=None):
             "Note: to use DoRA you need to install peft from main, `pip install git+https://github.com/huggingface/peft.git`"
         ),
     )
+    parser.add_argument(
+        "--max_train_steps_per_image",
+        type=int,
+        default=None,
+        help=(
+            "Scale the step budget with the dataset: train for this many steps per instance image, bounded by"
+            " `--min_train_steps` and `--max_train_steps`."
+        ),
+    )
+    parser.add_argument(
+        "--min_train_steps",
+        type=int,
+        default=0,
+        help="Lower bound for the step budget computed from `--max_train_steps_per_image`.",
+    )
+    parser.add_argument(
+        "--early_stopping_patience",
+        type=int,
+        default=None,
+        help=(
+            "Stop training once the smoothed training loss has not improved for this many optimization steps."
+            " Only checked in the last stage of `--resolution_schedule`. Disabled by default."
+        ),
+    )
+    parser.add_argument(
+        "--early_stopping_min_delta",
+        type=float,
+        default=0.01,
+        help="Minimum relative decrease of the smoothed loss that counts as an improvement for early stopping.",
+    )
+    parser.add_argument(
+        "--loss_ema_decay",
+        type=float,
+        default=0.98,
+        help="Decay of the exponential moving average used to smooth the training loss for early stopping.",
+    )
+    parser.add_argument(
+        "--resolution_schedule",
+        type=str,
+        default=None,
+        help=(
+            "Progressive training schedule as comma separated `resolution:fraction` stages, e.g. `512:0.4,1024:0.6`."
+            " Each stage trains for its fraction of `max_train_steps` at its resolution (at most `--resolution`),"
+            " in the given order. Defaults to a single stage at `--resolution`."
+        ),
+    )
+    parser.add_argument(
+        "--lazy_dataset",
+        action="store_true",
+        default=False,
+        help=(
+            "Store each instance image once as a resized uint8 array in a memory-mapped file and apply crop, flip and"
+            " normalisation lazily, instead of keeping a float32 tensor per image and repeat in memory."
+        ),
+    )
+    parser.add_argument(
+        "--dataset_storage_dir",
+        type=str,
+        default=None,
+        help="Directory for the temporary memory-mapped image arrays used with `--lazy_dataset`.",
+    )
+    parser.add_argument(
+        "--cache_latents",
+        action="store_true",
+        default=False,
+        help=(
+            "Encode every instance image (with its crop and flip) with the VAE once before training and train on the"
+            " cached latent distributions. The VAE is moved off the training device afterwards."
+        ),
+    )
+    parser.add_argument(
+        "--latents_cache_dir",
+        type=str,
+        default=None,
+        help=(
+            "Directory for the on-disk latent cache used with `--cache_latents`, keyed by image hash, resolution,"
+            " crop size, crop mode, crop, flip and VAE. Defaults to `output_dir/latents_cache`."
+        ),
+    )
 
     if input_args is not None:
         args = parser.parse_args(input_args)
     else:
         args = parser.parse_args()
 
+    env_local_rank = int(os.environ.get("LOCAL_RANK", -1))
+    if env_local_rank != -1 and env_local_rank != args.local_rank:
+        args.local_rank = env_local_rank
+
+    validate_args(args)
+    return args
+
+
+def validate_args(args):
+    """Checks the combination of arguments, both for the command line and for `TrainConfig.to_args`."""
     if args.dataset_name is None and args.instance_data_dir is None:
         raise ValueError("Specify either `--dataset_name` or `--instance_data_dir`")
 
     if args.dataset_name is not None and args.instance_data_dir is not None:
         raise ValueError("Specify only one of `--dataset_name` or `--instance_data_dir`")
 
-    env_local_rank = int(os.environ.get("LOCAL_RANK", -1))
-    if env_local_rank != -1 and env_local_rank != args.local_rank:
-        args.local_rank = env_local_rank
+    if args.early_stopping_patience is not None and not 0 < args.loss_ema_decay < 1:
+        raise ValueError("`--loss_ema_decay` must be in (0, 1).")
+
+    if args.resolution_schedule is not None:
+        # validate early, the step boundaries are computed once max_train_steps is known
+        parse_resolution_schedule(args.resolution_schedule, args.resolution)
+
+    if args.cache_latents and args.with_prior_preservation:
+        raise ValueError("`--cache_latents` does not support `--with_prior_preservation`.")
 
     if args.with_prior_preservation:
         if args.class_data_dir is None:
@@ -687,7 +788,99 @@ def parse_args(input_args=None):
         if args.class_prompt is not None:
             warnings.warn("You need not use --class_prompt without --with_prior_preservation.")
 
-    return args
+
+def parse_resolution_schedule(schedule, resolution):
+    """Parses `resolution:fraction,...` into a list of (resolution, fraction) stages."""
+    if schedule is None:
+        return [(resolution, 1.0)]
+
+    stages = []
+    for stage in schedule.split(","):
+        stage_resolution, fraction = stage.split(":")
+        stage_resolution, fraction = int(stage_resolution), float(fraction)
+        if stage_resolution % 8 != 0 or not 0 < stage_resolution <= resolution:
+            raise ValueError(
+                f"Stage resolution {stage_resolution} must be a positive multiple of 8 not larger than {resolution}."
+            )
+        if fraction <= 0:
+            raise ValueError(f"Stage fraction must be positive, got {fraction}.")
+        stages.append((stage_resolution, fraction))
+
+    total = sum(fraction for _, fraction in stages)
+    return [(stage_resolution, fraction / total) for stage_resolution, fraction in stages]
+
+
+def resize_pixel_values(pixel_values, resolution):
+    """Downscales a batch of square crops; together with the scaled crop coordinates this is equivalent to resizing
+    the image to `resolution` before cropping."""
+    if pixel_values.shape[-1] == resolution:
+        return pixel_values
+    return F.interpolate(pixel_values, size=(resolution, resolution), mode="bilinear", antialias=True)
+
+
+@dataclass
+class TrainConfig:
+    """
+    Typed configuration for calling `main` in-process instead of through `accelerate launch`.
+    Fields mirror the command line arguments of the same name; `overrides` sets any other argument.
+    """
+
+    instance_prompt: str
+    output_dir: str
+    pretrained_model_name_or_path: str = "stabilityai/stable-diffusion-xl-base-1.0"
+    pretrained_vae_model_name_or_path: str | None = "madebyollin/sdxl-vae-fp16-fix"
+    dataset_name: str | None = None
+    instance_data_dir: str | None = None
+    caption_column: str | None = None
+    cache_dir: str | None = None
+    resolution: int = 1024
+    resolution_schedule: str | None = None
+    train_batch_size: int = 1
+    gradient_accumulation_steps: int = 1
+    gradient_checkpointing: bool = False
+    learning_rate: float = 1e-4
+    snr_gamma: float | None = None
+    lr_scheduler: str = "constant"
+    lr_warmup_steps: int = 0
+    mixed_precision: str | None = None
+    use_8bit_adam: bool = False
+    max_train_steps: int | None = None
+    max_train_steps_per_image: int | None = None
+    min_train_steps: int = 0
+    early_stopping_patience: int | None = None
+    early_stopping_min_delta: float = 0.01
+    loss_ema_decay: float = 0.98
+    checkpointing_steps: int = 500
+    seed: int | None = None
+    lazy_dataset: bool = False
+    cache_latents: bool = False
+    latents_cache_dir: str | None = None
+    overrides: dict = field(default_factory=dict)
+
+    def to_args(self):
+        input_args = [
+            "--pretrained_model_name_or_path",
+            self.pretrained_model_name_or_path,
+            "--instance_prompt",
+            self.instance_prompt,
+        ]
+        if self.dataset_name is not None:
+            input_args += ["--dataset_name", self.dataset_name]
+        if self.instance_data_dir is not None:
+            input_args += ["--instance_data_dir", self.instance_data_dir]
+        # parse an (almost) empty command line to get the defaults
+        args = parse_args(input_args)
+
+        for config_field in fields(self):
+            if config_field.name != "overrides":
+                setattr(args, config_field.name, getattr(self, config_field.name))
+        for name, value in self.overrides.items():
+            if not hasattr(args, name):
+                raise ValueError(f"Unknown training argument: {name}")
+            setattr(args, name, value)
+        # the fields and overrides go through the same checks as the command line
+        validate_args(args)
+        return args
 
 
 class DreamBoothDataset(Dataset):
@@ -698,6 +891,7 @@ class DreamBoothDataset(Dataset):
 
     def __init__(
         self,
+        args,
         instance_data_root,
         instance_prompt,
         class_prompt,
@@ -774,14 +968,25 @@ class DreamBoothDataset(Dataset):
             instance_images = [Image.open(path) for path in list(Path(instance_data_root).iterdir())]
             self.custom_instance_prompts = None
 
-        self.instance_images = []
-        for img in instance_images:
-            self.instance_images.extend(itertools.repeat(img, repeats))
-
         # image processing to prepare for using SD-XL micro-conditioning
+        # the per-sample lists below have one entry per image and repeat, the pixel data itself is either stored
+        # eagerly as float32 tensors (one per repeat) or, with `lazy`, once per source image as a uint8 array in a
+        # memory-mapped file, with crop, flip and normalisation applied in `__getitem__`
+        self.repeats = repeats
+        self.lazy = args.lazy_dataset
         self.original_sizes = []
         self.crop_top_lefts = []
-        self.pixel_values = []
+        self.flips = []
+        self.image_hashes = []
+        self.pixel_values = None if self.lazy else []
+        # resolution -> list of cached latent distributions, one per sample
+        self.latent_dists = None
+        # caption -> (prompt_embeds, pooled_prompt_embeds), filled in when the text encoders are frozen
+        self.prompt_embeds = None
+        self.array_paths = []
+        self._arrays = {}
+        if self.lazy:
+            self._storage = tempfile.TemporaryDirectory(prefix="dreambooth_dataset_", dir=args.dataset_storage_dir)
         train_resize = transforms.Resize(size, interpolation=transforms.InterpolationMode.BILINEAR)
         train_crop = transforms.CenterCrop(size) if center_crop else transforms.RandomCrop(size)
         train_flip = transforms.RandomHorizontalFlip(p=1.0)
@@ -791,28 +996,37 @@ class DreamBoothDataset(Dataset):
                 transforms.Normalize([0.5], [0.5]),
             ]
         )
-        for image in self.instance_images:
+        for image in instance_images:
             image = exif_transpose(image)
             if not image.mode == "RGB":
                 image = image.convert("RGB")
-            self.original_sizes.append((image.height, image.width))
+            image_hash = hashlib.sha256(image.tobytes()).hexdigest()
+            original_size = (image.height, image.width)
             image = train_resize(image)
-            if args.random_flip and random.random() < 0.5:
-                # flip
-                image = train_flip(image)
-            if args.center_crop:
-                y1 = max(0, int(round((image.height - args.resolution) / 2.0)))
-                x1 = max(0, int(round((image.width - args.resolution) / 2.0)))
-                image = train_crop(image)
-            else:
-                y1, x1, h, w = train_crop.get_params(image, (args.resolution, args.resolution))
-                image = crop(image, y1, x1, h, w)
-            crop_top_left = (y1, x1)
-            self.crop_top_lefts.append(crop_top_left)
-            image = train_transforms(image)
-            self.pixel_values.append(image)
-
-        self.num_instance_images = len(self.instance_images)
+            if self.lazy:
+                array_path = Path(self._storage.name) / f"{len(self.array_paths)}.npy"
+                np.save(array_path, np.asarray(image, dtype=np.uint8))
+                self.array_paths.append(array_path)
+
+            for _ in range(repeats):
+                self.image_hashes.append(image_hash)
+                self.original_sizes.append(original_size)
+                flip = args.random_flip and random.random() < 0.5
+                self.flips.append(flip)
+                if args.center_crop:
+                    y1 = max(0, int(round((image.height - args.resolution) / 2.0)))
+                    x1 = max(0, int(round((image.width - args.resolution) / 2.0)))
+                else:
+                    y1, x1, h, w = train_crop.get_params(image, (args.resolution, args.resolution))
+                crop_top_left = (y1, x1)
+                self.crop_top_lefts.append(crop_top_left)
+                if not self.lazy:
+                    # flip before crop, the crop coordinates refer to the flipped image
+                    sample = train_flip(image) if flip else image
+                    sample = crop(sample, y1, x1, args.resolution, args.resolution)
+                    self.pixel_values.append(train_transforms(sample))
+
+        self.num_instance_images = len(self.crop_top_lefts)
         self._length = self.num_instance_images
 
         if class_data_root is not None:
@@ -839,12 +1053,33 @@ class DreamBoothDataset(Dataset):
     def __len__(self):
         return self._length
 
+    def get_pixel_values(self, sample_index):
+        if not self.lazy:
+            return self.pixel_values[sample_index]
+
+        # repeats share the source array: sample i belongs to source image i // repeats
+        source_index = sample_index // self.repeats
+        array = self._arrays.get(source_index)
+        if array is None:
+            array = self._arrays[source_index] = np.load(self.array_paths[source_index], mmap_mode="r")
+
+        if self.flips[sample_index]:
+            array = array[:, ::-1]
+        y1, x1 = self.crop_top_lefts[sample_index]
+        array = array[y1 : y1 + self.size, x1 : x1 + self.size]
+
+        pixel_values = torch.from_numpy(np.ascontiguousarray(array)).permute(2, 0, 1).float()
+        # same as ToTensor + Normalize([0.5], [0.5])
+        return pixel_values / 127.5 - 1.0
+
     def __getitem__(self, index):
         example = {}
-        instance_image = self.pixel_values[index % self.num_instance_images]
         original_size = self.original_sizes[index % self.num_instance_images]
         crop_top_left = self.crop_top_lefts[index % self.num_instance_images]
-        example["instance_images"] = instance_image
+        # the training loop looks up the cached latents of the current resolution stage by index
+        example["index"] = index % self.num_instance_images
+        if self.latent_dists is None:
+            example["instance_images"] = self.get_pixel_values(index % self.num_instance_images)
         example["original_size"] = original_size
         example["crop_top_left"] = crop_top_left
 
@@ -858,6 +1093,11 @@ class DreamBoothDataset(Dataset):
         else:  # costum prompts were provided, but length does not match size of image dataset
             example["instance_prompt"] = self.instance_prompt
 
+        if self.prompt_embeds is not None:
+            prompt_embeds, pooled_prompt_embeds = self.prompt_embeds[example["instance_prompt"]]
+            example["prompt_embeds"] = prompt_embeds
+            example["pooled_prompt_embeds"] = pooled_prompt_embeds
+
         if self.class_data_root:
             class_image = Image.open(self.class_images_path[index % self.num_class_images])
             class_image = exif_transpose(class_image)
@@ -871,6 +1111,16 @@ class DreamBoothDataset(Dataset):
 
 
 def collate_fn(examples, with_prior_preservation=False):
+    if "instance_images" not in examples[0]:
+        # cached latents are only supported without prior preservation
+        batch = {
+            "indices": [example["index"] for example in examples],
+            "prompts": [example["instance_prompt"] for example in examples],
+            "original_sizes": [example["original_size"] for example in examples],
+            "crop_top_lefts": [example["crop_top_left"] for example in examples],
+        }
+        return collate_prompt_embeds(examples, batch)
+
     pixel_values = [example["instance_images"] for example in examples]
     prompts = [example["instance_prompt"] for example in examples]
     original_sizes = [example["original_size"] for example in examples]
@@ -888,14 +1138,62 @@ def collate_fn(examples, with_prior_preservation=False):
     pixel_values = pixel_values.to(memory_format=torch.contiguous_format).float()
 
     batch = {
+        "indices": [example["index"] for example in examples],
         "pixel_values": pixel_values,
         "prompts": prompts,
         "original_sizes": original_sizes,
         "crop_top_lefts": crop_top_lefts,
     }
+    return collate_prompt_embeds(examples, batch)
+
+
+def collate_prompt_embeds(examples, batch):
+    # precomputed per-caption embeddings of the instance examples (class embeddings are appended in the training loop)
+    if "prompt_embeds" in examples[0]:
+        batch["prompt_embeds"] = torch.stack([example["prompt_embeds"] for example in examples])
+        batch["pooled_prompt_embeds"] = torch.stack([example["pooled_prompt_embeds"] for example in examples])
     return batch
 
 
+def cache_vae_latents(dataset, vae, cache_dir, vae_name, resolutions, device):
+    """
+    Encodes every instance image variant of `dataset` once per training resolution and stores the latent distribution
+    parameters (mean and logvar) as float16 safetensors files keyed by image hash, resolution, crop, flip and VAE.
+    The crop is identified by its top-left corner together with the base crop size and the crop mode it was taken
+    with. Cache hits update the file modification time so that the cache can be pruned by last use.
+    """
+    cache_dir = Path(cache_dir)
+    cache_dir.mkdir(parents=True, exist_ok=True)
+
+    latent_dists = {}
+    for resolution in resolutions:
+        latent_dists[resolution] = []
+        for i in tqdm(range(dataset.num_instance_images), desc=f"Caching latents ({resolution}px)"):
+            y1, x1 = dataset.crop_top_lefts[i]
+            key = (
+                f"{dataset.image_hashes[i]}-{resolution}-{dataset.size}-{dataset.center_crop}-{y1}-{x1}"
+                f"-{dataset.flips[i]}-{vae_name}"
+            )
+            cache_file = cache_dir / f"{hashlib.sha256(key.encode()).hexdigest()}.safetensors"
+
+            if cache_file.exists():
+                latent_dist = load_file(cache_file)["latent_dist"]
+                os.utime(cache_file)
+            else:
+                pixel_values = resize_pixel_values(dataset.get_pixel_values(i).unsqueeze(0), resolution)
+                pixel_values = pixel_values.to(device, dtype=vae.dtype)
+                with torch.no_grad():
+                    latent_dist = vae.encode(pixel_values).latent_dist.parameters[0]
+                latent_dist = latent_dist.to("cpu", dtype=torch.float16).contiguous()
+                # write to a temporary file first so that an interrupted job never leaves a truncated entry
+                tmp_file = cache_file.with_suffix(f".{os.getpid()}.tmp")
+                save_file({"latent_dist": latent_dist}, tmp_file)
+                os.replace(tmp_file, cache_file)
+            latent_dists[resolution].append(latent_dist)
+
+    return latent_dists
+
+
 class PromptDataset(Dataset):
     "A simple dataset to prepare the prompts to generate class images on multiple GPUs."
 
@@ -953,7 +1251,55 @@ def encode_prompt(text_encoders, tokenizers, prompt, text_input_ids_list=None):
     return prompt_embeds, pooled_prompt_embeds
 
 
-def main(args):
+# the modules of a shared pipeline that training moves, casts or patches
+SHARED_MODULES = ("unet", "vae", "text_encoder", "text_encoder_2")
+
+
+def restore_shared_components(components, placement):
+    """
+    Hands the shared modules back in their inference state: original forward (without the mixed precision wrapper),
+    no trained LoRA layers, no gradient checkpointing and the original devices and dtypes.
+    """
+    unet = extract_model_from_parallel(components["unet"], keep_fp32_wrapper=False)
+    if "default" in (getattr(unet, "peft_config", None) or {}):
+        unet.delete_adapters("default")
+    unet.disable_gradient_checkpointing()
+    for name in SHARED_MODULES:
+        module = components.get(name)
+        if module is not None:
+            module.requires_grad_(False)
+            module.eval()
+            device, dtype = placement[name]
+            module.to(device, dtype=dtype)
+    gc.collect()
+    if torch.cuda.is_available():
+        torch.cuda.empty_cache()
+
+
+def main(args, components=None, on_progress=None, should_stop=None):
+    # `components` are already loaded pipeline modules (e.g. `StableDiffusionXLPipeline.components` of a resident
+    # inference pipeline). When given, the tokenizers, text encoders, VAE and UNet are reused instead of being loaded
+    # from disk again, and are handed back without the trained LoRA layers when training ends, also when it fails.
+    # `on_progress(step, total)` is called on the main process after every optimization step.
+    # `should_stop()` is checked before every step; once it returns True training ends without saving the weights.
+    if components is None:
+        return run_training(args, on_progress=on_progress, should_stop=should_stop)
+
+    placement = {
+        name: (components[name].device, components[name].dtype)
+        for name in SHARED_MODULES
+        if components.get(name) is not None
+    }
+    try:
+        return run_training(args, components=components, on_progress=on_progress, should_stop=should_stop)
+    finally:
+        restore_shared_components(components, placement)
+
+
+def run_training(args, components=None, on_progress=None, should_stop=None):
+    if components is not None and args.train_text_encoder:
+        raise ValueError("Training the text encoder is not supported with shared pipeline components.")
+
     if args.report_to == "wandb" and args.hub_token is not None:
         raise ValueError(
             "You cannot use both --report_to=wandb and --hub_token due to a security risk of exposing your token."
@@ -1064,27 +1410,33 @@ def main(args):
                 repo_id=args.hub_model_id or Path(args.output_dir).name, exist_ok=True, token=args.hub_token
             ).repo_id
 
-    # Load the tokenizers
-    tokenizer_one = AutoTokenizer.from_pretrained(
-        args.pretrained_model_name_or_path,
-        subfolder="tokenizer",
-        revision=args.revision,
-        use_fast=False,
-    )
-    tokenizer_two = AutoTokenizer.from_pretrained(
-        args.pretrained_model_name_or_path,
-        subfolder="tokenizer_2",
-        revision=args.revision,
-        use_fast=False,
-    )
+    if components is None:
+        # Load the tokenizers
+        tokenizer_one = AutoTokenizer.from_pretrained(
+            args.pretrained_model_name_or_path,
+            subfolder="tokenizer",
+            revision=args.revision,
+            use_fast=False,
+        )
+        tokenizer_two = AutoTokenizer.from_pretrained(
+            args.pretrained_model_name_or_path,
+            subfolder="tokenizer_2",
+            revision=args.revision,
+            use_fast=False,
+        )
 
-    # import correct text encoder classes
-    text_encoder_cls_one = import_model_class_from_model_name_or_path(
-        args.pretrained_model_name_or_path, args.revision
-    )
-    text_encoder_cls_two = import_model_class_from_model_name_or_path(
-        args.pretrained_model_name_or_path, args.revision, subfolder="text_encoder_2"
-    )
+        # import correct text encoder classes
+        text_encoder_cls_one = import_model_class_from_model_name_or_path(
+            args.pretrained_model_name_or_path, args.revision
+        )
+        text_encoder_cls_two = import_model_class_from_model_name_or_path(
+            args.pretrained_model_name_or_path, args.revision, subfolder="text_encoder_2"
+        )
+    else:
+        tokenizer_one = components["tokenizer"]
+        tokenizer_two = components["tokenizer_2"]
+        text_encoder_cls_one = type(components["text_encoder"])
+        text_encoder_cls_two = type(components["text_encoder_2"])
 
     # Load scheduler and models
     scheduler_type = determine_scheduler_type(args.pretrained_model_name_or_path, args.revision)
@@ -1100,32 +1452,40 @@ def main(args):
     else:
         noise_scheduler = DDPMScheduler.from_pretrained(args.pretrained_model_name_or_path, subfolder="scheduler")
 
-    text_encoder_one = text_encoder_cls_one.from_pretrained(
-        args.pretrained_model_name_or_path, subfolder="text_encoder", revision=args.revision, variant=args.variant
-    )
-    text_encoder_two = text_encoder_cls_two.from_pretrained(
-        args.pretrained_model_name_or_path, subfolder="text_encoder_2", revision=args.revision, variant=args.variant
-    )
     vae_path = (
         args.pretrained_model_name_or_path
         if args.pretrained_vae_model_name_or_path is None
         else args.pretrained_vae_model_name_or_path
     )
-    vae = AutoencoderKL.from_pretrained(
-        vae_path,
-        subfolder="vae" if args.pretrained_vae_model_name_or_path is None else None,
-        revision=args.revision,
-        variant=args.variant,
-    )
+    if components is None:
+        text_encoder_one = text_encoder_cls_one.from_pretrained(
+            args.pretrained_model_name_or_path, subfolder="text_encoder", revision=args.revision, variant=args.variant
+        )
+        text_encoder_two = text_encoder_cls_two.from_pretrained(
+            args.pretrained_model_name_or_path, subfolder="text_encoder_2", revision=args.revision, variant=args.variant
+        )
+        vae = AutoencoderKL.from_pretrained(
+            vae_path,
+            subfolder="vae" if args.pretrained_vae_model_name_or_path is None else None,
+            revision=args.revision,
+            variant=args.variant,
+        )
+    else:
+        text_encoder_one = components["text_encoder"]
+        text_encoder_two = components["text_encoder_2"]
+        vae = components["vae"]
     latents_mean = latents_std = None
     if hasattr(vae.config, "latents_mean") and vae.config.latents_mean is not None:
         latents_mean = torch.tensor(vae.config.latents_mean).view(1, 4, 1, 1)
     if hasattr(vae.config, "latents_std") and vae.config.latents_std is not None:
         latents_std = torch.tensor(vae.config.latents_std).view(1, 4, 1, 1)
 
-    unet = UNet2DConditionModel.from_pretrained(
-        args.pretrained_model_name_or_path, subfolder="unet", revision=args.revision, variant=args.variant
-    )
+    if components is None:
+        unet = UNet2DConditionModel.from_pretrained(
+            args.pretrained_model_name_or_path, subfolder="unet", revision=args.revision, variant=args.variant
+        )
+    else:
+        unet = components["unet"]
 
     # We only train the additional adapter LoRA layers
     vae.requires_grad_(False)
@@ -1407,6 +1767,7 @@ def main(args):
 
     # Dataset and DataLoaders creation:
     train_dataset = DreamBoothDataset(
+        args=args,
         instance_data_root=args.instance_data_dir,
         instance_prompt=args.instance_prompt,
         class_prompt=args.class_prompt,
@@ -1417,6 +1778,24 @@ def main(args):
         center_crop=args.center_crop,
     )
 
+    resolution_stages = parse_resolution_schedule(args.resolution_schedule, args.resolution)
+
+    if args.cache_latents:
+        train_dataset.latent_dists = cache_vae_latents(
+            train_dataset,
+            vae,
+            cache_dir=args.latents_cache_dir or os.path.join(args.output_dir, "latents_cache"),
+            vae_name=vae_path,
+            resolutions=sorted({stage_resolution for stage_resolution, _ in resolution_stages}),
+            device=accelerator.device,
+        )
+        # the pixel values and the VAE are not needed on the device during training anymore
+        train_dataset.pixel_values = None
+        vae.to("cpu")
+        gc.collect()
+        if torch.cuda.is_available():
+            torch.cuda.empty_cache()
+
     train_dataloader = torch.utils.data.DataLoader(
         train_dataset,
         batch_size=args.train_batch_size,
@@ -1430,9 +1809,9 @@ def main(args):
     # pooled text embeddings
     # time ids
 
-    def compute_time_ids(original_size, crops_coords_top_left):
+    def compute_time_ids(original_size, crops_coords_top_left, resolution):
         # Adapted from pipeline.StableDiffusionXLPipeline._get_add_time_ids
-        target_size = (args.resolution, args.resolution)
+        target_size = (resolution, resolution)
         add_time_ids = list(original_size + crops_coords_top_left + target_size)
         add_time_ids = torch.tensor([add_time_ids])
         add_time_ids = add_time_ids.to(accelerator.device, dtype=weight_dtype)
@@ -1464,9 +1843,31 @@ def main(args):
                 args.class_prompt, text_encoders, tokenizers
             )
 
+    # If custom instance prompts are provided but the text encoders are frozen, encode every unique caption once
+    # and let the dataset serve the cached embeddings instead of running both text encoders on every step.
+    if not args.train_text_encoder and train_dataset.custom_instance_prompts:
+        captions = {caption for caption in train_dataset.custom_instance_prompts if caption}
+        captions.add(args.instance_prompt)
+        train_dataset.prompt_embeds = {}
+        for caption in captions:
+            caption_prompt_embeds, caption_pooled_prompt_embeds = compute_text_embeddings(
+                caption, text_encoders, tokenizers
+            )
+            train_dataset.prompt_embeds[caption] = (
+                caption_prompt_embeds[0].cpu(),
+                caption_pooled_prompt_embeds[0].cpu(),
+            )
+        logger.info(f"Cached text embeddings for {len(captions)} unique captions")
+
     # Clear the memory here
-    if not args.train_text_encoder and not train_dataset.custom_instance_prompts:
+    if not args.train_text_encoder:
+        # all prompts are encoded at this point, the frozen text encoders are not needed during training.
+        # Shared components stay alive in their owner, so dropping our references alone would keep them on the
+        # device; they are moved off it instead and `restore_shared_components` moves them back afterwards
+        text_encoder_one.to("cpu")
+        text_encoder_two.to("cpu")
         del tokenizers, text_encoders
+        text_encoder_one = text_encoder_two = None
         gc.collect()
         if torch.cuda.is_available():
             torch.cuda.empty_cache()
@@ -1496,6 +1897,12 @@ def main(args):
     # Scheduler and math around the number of training steps.
     overrode_max_train_steps = False
     num_update_steps_per_epoch = math.ceil(len(train_dataloader) / args.gradient_accumulation_steps)
+    if args.max_train_steps_per_image is not None:
+        # a few photos need far fewer steps than a few dozen, `max_train_steps` stays the upper bound
+        steps_budget = max(args.max_train_steps_per_image * train_dataset.num_instance_images, args.min_train_steps)
+        if args.max_train_steps is not None:
+            steps_budget = min(steps_budget, args.max_train_steps)
+        args.max_train_steps = steps_budget
     if args.max_train_steps is None:
         args.max_train_steps = args.num_train_epochs * num_update_steps_per_epoch
         overrode_max_train_steps = True
@@ -1547,8 +1954,38 @@ def main(args):
     logger.info(f"  Total train batch size (w. parallel, distributed & accumulation) = {total_batch_size}")
     logger.info(f"  Gradient Accumulation steps = {args.gradient_accumulation_steps}")
     logger.info(f"  Total optimization steps = {args.max_train_steps}")
+
+    # turn the schedule fractions into [start, end) step ranges; the last stage absorbs rounding
+    stage_bounds = []
+    stage_start = 0
+    for i, (stage_resolution, fraction) in enumerate(resolution_stages):
+        if i == len(resolution_stages) - 1:
+            stage_end = args.max_train_steps
+        else:
+            stage_end = min(stage_start + round(fraction * args.max_train_steps), args.max_train_steps)
+        stage_bounds.append((stage_resolution, stage_start, stage_end))
+        stage_start = stage_bounds[-1][2]
+    if len(stage_bounds) > 1:
+        logger.info(f"  Resolution stages = {[(r, end - start) for r, start, end in stage_bounds]}")
+    stage_seconds = [0.0] * len(stage_bounds)
+
+    def get_stage(step):
+        for i, (_, start, end) in enumerate(stage_bounds):
+            if step < end:
+                return i
+        return len(stage_bounds) - 1
+
     global_step = 0
     first_epoch = 0
+    stop_reason = "max_train_steps"
+
+    # early stopping state: bias corrected EMA of the loss of the current resolution stage
+    loss_ema_stage = None
+    loss_ema = 0.0
+    loss_ema_steps = 0
+    best_loss_ema = float("inf")
+    steps_since_improvement = 0
+    accumulated_loss = 0.0
 
     # Potentially load in the weights and states from a previous save
     if args.resume_from_checkpoint:
@@ -1609,22 +2046,47 @@ def main(args):
             accelerator.unwrap_model(text_encoder_two).text_model.embeddings.requires_grad_(True)
 
         for step, batch in enumerate(train_dataloader):
+            if should_stop is not None and should_stop():
+                stop_reason = "cancelled"
+                logger.info(f"Training cancelled at step {global_step}")
+                break
+
+            step_started_at = time.perf_counter()
+            stage = get_stage(global_step)
+            stage_resolution = stage_bounds[stage][0]
+
             with accelerator.accumulate(unet):
-                pixel_values = batch["pixel_values"].to(dtype=vae.dtype)
                 prompts = batch["prompts"]
 
                 # encode batch prompts when custom prompts are provided for each image -
                 if train_dataset.custom_instance_prompts:
                     if not args.train_text_encoder:
-                        prompt_embeds, unet_add_text_embeds = compute_text_embeddings(
-                            prompts, text_encoders, tokenizers
-                        )
+                        # per-caption embeddings were computed once before training
+                        prompt_embeds = batch["prompt_embeds"].to(accelerator.device)
+                        unet_add_text_embeds = batch["pooled_prompt_embeds"].to(accelerator.device)
+                        if args.with_prior_preservation:
+                            num_class = len(prompts) - prompt_embeds.shape[0]
+                            prompt_embeds = torch.cat(
+                                [prompt_embeds, class_prompt_hidden_states.repeat(num_class, 1, 1)], dim=0
+                            )
+                            unet_add_text_embeds = torch.cat(
+                                [unet_add_text_embeds, class_pooled_prompt_embeds.repeat(num_class, 1)], dim=0
+                            )
                     else:
                         tokens_one = tokenize_prompt(tokenizer_one, prompts)
                         tokens_two = tokenize_prompt(tokenizer_two, prompts)
 
                 # Convert images to latent space
-                model_input = vae.encode(pixel_values).latent_dist.sample()
+                if args.cache_latents:
+                    latent_dists = torch.stack(
+                        [train_dataset.latent_dists[stage_resolution][i] for i in batch["indices"]]
+                    )
+                    latent_dists = latent_dists.to(accelerator.device, dtype=torch.float32)
+                    model_input = DiagonalGaussianDistribution(latent_dists).sample()
+                else:
+                    pixel_values = resize_pixel_values(batch["pixel_values"], stage_resolution)
+                    pixel_values = pixel_values.to(dtype=vae.dtype)
+                    model_input = vae.encode(pixel_values).latent_dist.sample()
 
                 if latents_mean is None and latents_std is None:
                     model_input = model_input * vae.config.scaling_factor
@@ -1666,10 +2128,15 @@ def main(args):
                     else:
                         inp_noisy_latents = noisy_model_input / ((sigmas**2 + 1) ** 0.5)
 
-                # time ids
+                # time ids, crop coordinates were taken at `args.resolution` and scale with the stage resolution
+                scale = stage_resolution / args.resolution
                 add_time_ids = torch.cat(
                     [
-                        compute_time_ids(original_size=s, crops_coords_top_left=c)
+                        compute_time_ids(
+                            original_size=s,
+                            crops_coords_top_left=(round(c[0] * scale), round(c[1] * scale)),
+                            resolution=stage_resolution,
+                        )
                         for s, c in zip(batch["original_sizes"], batch["crop_top_lefts"])
                     ]
                 )
@@ -1816,6 +2283,8 @@ def main(args):
             if accelerator.sync_gradients:
                 progress_bar.update(1)
                 global_step += 1
+                if on_progress is not None and accelerator.is_main_process:
+                    on_progress(global_step, args.max_train_steps)
 
                 if accelerator.is_main_process:
                     if global_step % args.checkpointing_steps == 0:
@@ -1844,12 +2313,54 @@ def main(args):
                         logger.info(f"Saved state to {save_path}")
 
             logs = {"loss": loss.detach().item(), "lr": lr_scheduler.get_last_lr()[0]}
+            # `.item()` above synchronizes with the device, so the wall-clock time covers the whole step
+            stage_seconds[stage] += time.perf_counter() - step_started_at
+            logs["resolution"] = stage_resolution
+
+            accumulated_loss += logs["loss"] / args.gradient_accumulation_steps
+            if accelerator.sync_gradients and args.early_stopping_patience is not None:
+                step_loss = torch.tensor(accumulated_loss, device=accelerator.device)
+                step_loss = accelerator.reduce(step_loss, reduction="mean").item()
+
+                if stage != loss_ema_stage:
+                    # the loss level depends on the resolution, start smoothing over in every stage
+                    loss_ema_stage = stage
+                    loss_ema, loss_ema_steps = 0.0, 0
+                    best_loss_ema, steps_since_improvement = float("inf"), 0
+                loss_ema = args.loss_ema_decay * loss_ema + (1 - args.loss_ema_decay) * step_loss
+                loss_ema_steps += 1
+                smoothed_loss = loss_ema / (1 - args.loss_ema_decay**loss_ema_steps)
+                logs["loss_ema"] = smoothed_loss
+
+                if smoothed_loss < best_loss_ema * (1 - args.early_stopping_min_delta):
+                    best_loss_ema = smoothed_loss
+                    steps_since_improvement = 0
+                else:
+                    steps_since_improvement += 1
+
+                # plateau at a low resolution only means the stage is done, not the training
+                if (
+                    stage == len(stage_bounds) - 1
+                    and steps_since_improvement >= args.early_stopping_patience
+                    and global_step >= args.min_train_steps
+                ):
+                    stop_reason = "converged"
+                    logger.info(
+                        f"Loss plateaued for {steps_since_improvement} steps at {smoothed_loss:.4f}, "
+                        f"stopping at step {global_step}"
+                    )
+            if accelerator.sync_gradients:
+                accumulated_loss = 0.0
+
             progress_bar.set_postfix(**logs)
             accelerator.log(logs, step=global_step)
 
-            if global_step >= args.max_train_steps:
+            if global_step >= args.max_train_steps or stop_reason == "converged":
                 break
 
+        if stop_reason == "cancelled":
+            break
+
         if accelerator.is_main_process:
             if args.validation_prompt is not None and epoch % args.validation_epochs == 0:
                 # create pipeline
@@ -1886,12 +2397,21 @@ def main(args):
                     epoch,
                 )
 
+        if stop_reason == "converged":
+            break
+
     # Save the lora layers
     accelerator.wait_for_everyone()
-    if accelerator.is_main_process:
+    if accelerator.is_main_process and stop_reason != "cancelled":
         unet = unwrap_model(unet)
-        unet = unet.to(torch.float32)
-        unet_lora_layers = convert_state_dict_to_diffusers(get_peft_model_state_dict(unet))
+        if components is None:
+            unet = unet.to(torch.float32)
+            unet_lora_layers = convert_state_dict_to_diffusers(get_peft_model_state_dict(unet))
+        else:
+            # the LoRA layers are already float32, upcasting the whole shared UNet is not needed
+            unet_lora_layers = convert_state_dict_to_diffusers(
+                {k: v.to(torch.float32) for k, v in get_peft_model_state_dict(unet).items()}
+            )
 
         if args.train_text_encoder:
             text_encoder_one = unwrap_model(text_encoder_one)
@@ -1919,28 +2439,29 @@ def main(args):
             save_file(kohya_state_dict, f"{args.output_dir}/pytorch_lora_weights_kohya.safetensors")
 
         # Final inference
-        # Load previous pipeline
-        vae = AutoencoderKL.from_pretrained(
-            vae_path,
-            subfolder="vae" if args.pretrained_vae_model_name_or_path is None else None,
-            revision=args.revision,
-            variant=args.variant,
-            torch_dtype=weight_dtype,
-        )
-        pipeline = StableDiffusionXLPipeline.from_pretrained(
-            args.pretrained_model_name_or_path,
-            vae=vae,
-            revision=args.revision,
-            variant=args.variant,
-            torch_dtype=weight_dtype,
-        )
-
-        # load attention processors
-        pipeline.load_lora_weights(args.output_dir)
-
-        # run inference
+        # The pipeline is only needed for the final validation, skip loading SDXL again otherwise
         images = []
         if args.validation_prompt and args.num_validation_images > 0:
+            # Load previous pipeline
+            final_vae = AutoencoderKL.from_pretrained(
+                vae_path,
+                subfolder="vae" if args.pretrained_vae_model_name_or_path is None else None,
+                revision=args.revision,
+                variant=args.variant,
+                torch_dtype=weight_dtype,
+            )
+            pipeline = StableDiffusionXLPipeline.from_pretrained(
+                args.pretrained_model_name_or_path,
+                vae=final_vae,
+                revision=args.revision,
+                variant=args.variant,
+                torch_dtype=weight_dtype,
+            )
+
+            # load attention processors
+            pipeline.load_lora_weights(args.output_dir)
+
+            # run inference
             pipeline_args = {"prompt": args.validation_prompt, "num_inference_steps": 25}
             images = log_validation(
                 pipeline,
@@ -1972,6 +2493,25 @@ def main(args):
 
     accelerator.end_training()
 
+    del optimizer, lr_scheduler, train_dataloader
+    accelerator.free_memory()
+    gc.collect()
+    if torch.cuda.is_available():
+        torch.cuda.empty_cache()
+
+    stages = [
+        {
+            "resolution": stage_resolution,
+            "steps": max(0, min(end, global_step) - start),
+            "seconds": round(seconds, 1),
+        }
+        for (stage_resolution, start, end), seconds in zip(stage_bounds, stage_seconds)
+    ]
+    for stage in stages:
+        logger.info(f"Stage {stage['resolution']}px: {stage['steps']} steps in {stage['seconds']}s")
+
+    return {"steps": global_step, "max_train_steps": args.max_train_steps, "stop_reason": stop_reason, "stages": stages}
+
 
 if __name__ == "__main__":
     args = parse_args()
@@ -1,17 +1,47 @@
+import functools
 import json
 import os
 import pathlib
 import pika
+import time
+from concurrent.futures import ThreadPoolExecutor
 
 from tenacity import Retrying, RetryError, stop_after_attempt
 
 import ControlNet
 import Lora
+from adapters import LoraPipeline
+from cancellation import CancelToken, TaskCancelled
+from captioner import Captioner
+from encoding import OutputEncoder
 
 APP_DIR = pathlib.Path(__file__).parent.resolve()
 HUGGINGFACE_CACHE_DIR = APP_DIR / "../storage/cache"
 HUGGINGFACE_CACHE_DIR.mkdir(parents=True, exist_ok=True)
 
+# сколько картинок максимум генерировать за один вызов пайплайна (по умолчанию - все сразу)
+GENERATION_BATCH_SIZE = int(os.environ.get('GENERATION_BATCH_SIZE', 0)) or None
+
+# интервал heartbeat в секундах: задачи выполняются не в потоке соединения,
+# поэтому соединение отвечает брокеру и во время долгого обучения
+RABBITMQ_HEARTBEAT = int(os.environ.get('RABBITMQ_HEARTBEAT', 60))
+
+# как часто (в шагах) отправлять прогресс обучения, если клиент ждет промежуточные события
+TRAIN_PROGRESS_EVERY = int(os.environ.get('TRAIN_PROGRESS_EVERY', 10))
+
+# очереди (типы задач), которые слушает этот воркер; на одной видеокарте - обе,
+# тогда запросы на инференс обслуживаются между задачами обучения
+WORKER_LANES = [lane.strip() for lane in os.environ.get('WORKER_LANES', 'model_train,model_inference').split(',') if lane.strip()]
+
+# расписание обучения LoRA по разрешениям "разрешение:доля шагов,...", пусто - все шаги на 1024
+TRAIN_RESOLUTION_SCHEDULE = os.environ.get('TRAIN_RESOLUTION_SCHEDULE') or None
+
+
+# exchange, через который API рассылает отмену задач всем воркерам
+CANCEL_EXCHANGE = 'cancel'
+# сколько секунд помнить отмененные задачи
+CANCELLED_TTL = 24 * 3600
+
 
 class Consumer:
     # https://www.rabbitmq.com/tutorials/tutorial-two-python
@@ -20,7 +50,26 @@ class Consumer:
     def __init__(self):
         self.connection = None
         self.channel = None
-        self.queue_name = 'main'
+        self.queue_names = WORKER_LANES
+
+        # correlation_id отмененных задач -> время отмены; пишется в потоке соединения, читается в потоке executor
+        self.cancelled = {}
+        self.cancel_queue = None
+
+        # https://pika.readthedocs.io/en/stable/modules/adapters/blocking.html#pika.adapters.blocking_connection.BlockingConnection.add_callback_threadsafe
+        # задачи выполняются по одной в отдельном потоке (видеокарта одна), поток соединения
+        # только принимает сообщения, а ответы и подтверждения отправляет через add_callback_threadsafe
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='model')
+
+        # базовый SDXL живет все время работы воркера, меняются только LoRA адаптеры
+        self.lora_pipeline = LoraPipeline(
+            cache_dir=HUGGINGFACE_CACHE_DIR,
+            max_adapters=int(os.environ.get('LORA_CACHE_MAX_ADAPTERS', 8)),
+            max_bytes=int(os.environ.get('LORA_CACHE_MAX_BYTES', 2 * 1024**3)),
+        )
+        self.captioner = Captioner(cache_dir=HUGGINGFACE_CACHE_DIR)
+        # картинки сохраняются в своих потоках параллельно с генерацией следующих
+        self.encoder = OutputEncoder()
 
     def connect(self):
         if not self.connection or self.connection.is_closed:
@@ -33,7 +82,7 @@ class Consumer:
                     ),
                     host=os.environ.get('RABBITMQ_HOST'),
                     port=os.environ.get('RABBITMQ_PORT'),
-                    heartbeat=0
+                    heartbeat=RABBITMQ_HEARTBEAT
                 )
             )
 
@@ -42,26 +91,92 @@ class Consumer:
     def create_channel(self):
         if not self.channel or self.channel.is_closed:
             self.channel = self.connection.channel()
-            self.channel.queue_declare(
-                queue=self.queue_name, 
-                durable=True
-            )
+            for queue_name in self.queue_names:
+                self.channel.queue_declare(
+                    queue=queue_name, 
+                    durable=True
+                )
+
+            # https://www.rabbitmq.com/tutorials/tutorial-three-python
+            # у каждого воркера своя временная очередь отмен
+            self.channel.exchange_declare(exchange=CANCEL_EXCHANGE, exchange_type='fanout')
+            self.cancel_queue = self.channel.queue_declare(queue='', exclusive=True).method.queue
+            self.channel.queue_bind(exchange=CANCEL_EXCHANGE, queue=self.cancel_queue)
+
+    def on_cancel(self, channel, method, properties, body):
+        now = time.time()
+        self.cancelled[json.loads(body)['correlation_id']] = now
+        for correlation_id, cancelled_at in list(self.cancelled.items()):
+            if now - cancelled_at > CANCELLED_TTL:
+                del self.cancelled[correlation_id]
+
+    # срок задачи API передает в заголовке x-deadline (unix time)
+    def cancel_token(self, properties) -> CancelToken:
+        deadline = (properties.headers or {}).get('x-deadline')
+        return CancelToken(
+            self.cancelled,
+            correlation_id=properties.correlation_id,
+            deadline=float(deadline) if deadline is not None else None
+        )
 
     def on_request(self, channel, method, properties, body):
         params = json.loads(body)
+        self.executor.submit(self.run_task, method, properties, params)
 
+    # выполняется в потоке executor
+    def run_task(self, method, properties, params):
         task = params.pop('task')
+        # клиент просит промежуточные события: прогресс обучения и каждую картинку сразу после сохранения
+        on_event = self.event_sender(properties) if params.pop('stream', False) else None
+        should_stop = self.cancel_token(properties)
         error = ''
         result = None
+        info = {}
 
         try:
+            # просроченную или отмененную задачу даже не начинаем
+            should_stop.check()
             if task == 'model_train':
-                result = model_train(**params)
+                result, info = model_train(lora_pipeline=self.lora_pipeline, captioner=self.captioner, encoder=self.encoder, on_event=on_event, should_stop=should_stop, **params)
             elif task == 'model_inference':
-                result = model_inference_Lora(**params)
+                result = model_inference_Lora(lora_pipeline=self.lora_pipeline, encoder=self.encoder, on_event=on_event, should_stop=should_stop, **params)
+        except TaskCancelled:
+            result = None
+            error = f"Task {should_stop.reason() or 'cancelled'}"
         except Exception as e:
             error = str(e)
 
+        self.reply_threadsafe(method, properties, result, error, info)
+
+    # канал pika не потокобезопасен - публикация и ack выполняются в потоке соединения
+    def reply_threadsafe(self, method, properties, result, error, info=None):
+        self.connection.add_callback_threadsafe(
+            functools.partial(self.send_reply, method, properties, result, error, info)
+        )
+
+    def event_sender(self, properties):
+        def on_event(event):
+            self.connection.add_callback_threadsafe(
+                functools.partial(self.send_event, properties, event)
+            )
+        return on_event
+
+    # промежуточное событие задачи с тем же correlation_id, что и итоговый ответ
+    def send_event(self, properties, event):
+        try:
+            self.channel.basic_publish(
+                exchange='',
+                routing_key=properties.reply_to,
+                properties=pika.BasicProperties(
+                    correlation_id=properties.correlation_id
+                ),
+                body=json.dumps(event)
+            )
+        except pika.exceptions.AMQPError as e:
+            # потерянное промежуточное событие не мешает итоговому ответу
+            print(e)
+
+    def send_reply(self, method, properties, result, error, info=None):
         # convert pathlib.Path objects to strings
         if result:
             result = [str(item.resolve()) for item in result]
@@ -69,32 +184,52 @@ class Consumer:
         try:
             for attempt in Retrying(stop=stop_after_attempt(3)):
                 with attempt:
-                    channel.basic_publish(
+                    self.channel.basic_publish(
                         exchange='',
                         routing_key=properties.reply_to,
                         properties=pika.BasicProperties(
-                            correlation_id=properties.correlation_id
+                            correlation_id=properties.correlation_id,
+                            # итоговый ответ в постоянную очередь job_results переживает и перезапуск брокера
+                            delivery_mode=2
                         ),
                         body=json.dumps({
+                            'event': 'result',
                             'result': result,
-                            'error': error
+                            'error': error,
+                            'info': info or {},
                         })
                     )
         except RetryError as e:
             print(e)
 
-        channel.basic_ack(delivery_tag=method.delivery_tag)
+        self.channel.basic_ack(delivery_tag=method.delivery_tag)
 
     def wait_messages(self):
+        # https://www.rabbitmq.com/docs/consumer-prefetch
+        # prefetch задается на каждого потребителя и ограничивает буфер неподтвержденных задач воркера:
+        # задачи берем по одной, чтобы следующая приходила только после подтверждения
+        for queue_name in self.queue_names:
+            self.channel.basic_qos(prefetch_count=1)
+            self.channel.basic_consume(
+                queue=queue_name, 
+                on_message_callback=self.on_request
+            )
         self.channel.basic_consume(
-            queue=self.queue_name, 
-            on_message_callback=self.on_request
+            queue=self.cancel_queue,
+            on_message_callback=self.on_cancel,
+            auto_ack=True
         )
         self.channel.start_consuming()
        
     def disconnect(self):
+        # дожидаемся текущей задачи, еще не начатые брокер отдаст заново после закрытия соединения
+        self.executor.shutdown(wait=True, cancel_futures=True)
+        self.encoder.close()
+
         if self.connection:
             self.channel.stop_consuming()
+            # отправляем ответы, поставленные в очередь из потока executor
+            self.connection.process_data_events(time_limit=0)
             self.channel.close()
             self.connection.close()
         
@@ -102,16 +237,40 @@ class Consumer:
         self.channel = None
 
 
-def model_train(model_dir: str, prompt: str, model_name: str = 'Lora', type_person: str = 'women') -> list[str]:
+def image_event(path: pathlib.Path) -> dict:
+    return {'event': 'image', 'image': str(path.resolve())}
+
+
+# on_progress(step, total) для обучения: шлет событие раз в TRAIN_PROGRESS_EVERY шагов и на последнем
+def progress_sender(on_event):
+    def on_progress(step, total):
+        if step % TRAIN_PROGRESS_EVERY == 0 or step == total:
+            on_event({'event': 'progress', 'stage': 'train', 'step': step, 'total': total})
+    return on_progress
+
+
+# on_image(path) для генерации: шлет событие о каждой сохраненной картинке
+def image_sender(on_event):
+    def on_image(path):
+        on_event(image_event(path))
+    return on_image
+
+
+def model_train(lora_pipeline: LoraPipeline, captioner: Captioner, encoder: OutputEncoder, model_dir: str, prompt: str, model_name: str = 'Lora', type_person: str = 'women', num_images: int = 4, image_hashes: dict | None = None, on_event=None, should_stop=None) -> tuple[list[str], dict]:
+    on_progress = progress_sender(on_event) if on_event is not None else None
+    on_image = image_sender(on_event) if on_event is not None else None
+
     if model_name == 'Lora':
         instance = Lora.DreamBoth_LoRA(
             model_dir=model_dir, 
             cache_dir=HUGGINGFACE_CACHE_DIR, 
             prompt=prompt, 
-            type_person=type_person
+            type_person=type_person,
+            resolution_schedule=TRAIN_RESOLUTION_SCHEDULE,
+            image_hashes=image_hashes
         )
-        instance.train()
-        return instance.inference()
+        info = instance.train(captioner, lora_pipeline, on_progress=on_progress, should_stop=should_stop)
+        return instance.inference(lora_pipeline, encoder, num_images=num_images, batch_size=GENERATION_BATCH_SIZE, on_image=on_image, should_stop=should_stop), info
     elif model_name == 'ControlNet':
         instance = ControlNet.ControlNet(
             model_dir=model_dir, 
@@ -119,14 +278,25 @@ def model_train(model_dir: str, prompt: str, model_name: str = 'Lora', type_pers
             prompt=prompt
         )
         instance.get_model()
-        return instance.generate()
+        return instance.generate(encoder, num_images=num_images, batch_size=GENERATION_BATCH_SIZE, on_image=on_image, should_stop=should_stop), {}
+    raise ValueError(f"Unknown model: {model_name}")
     
 
-def model_inference_Lora(model_dir: str, prompt: str, type_person: str = 'women') -> list[str]:
+def model_inference_Lora(lora_pipeline: LoraPipeline, encoder: OutputEncoder, model_dir: str, prompt: str, type_person: str = 'women', num_images: int = 4, num_inference_steps: int = 25, resolution: int | None = None, on_event=None, should_stop=None) -> list[str]:
     instance = Lora.DreamBoth_LoRA(
         model_dir=model_dir, 
         cache_dir=HUGGINGFACE_CACHE_DIR, 
         prompt=prompt, 
         type_person=type_person
     )
-    return instance.inference()
+    return instance.inference(
+        lora_pipeline, 
+        encoder,
+        num_images=num_images, 
+        batch_size=GENERATION_BATCH_SIZE,
+        num_inference_steps=num_inference_steps,
+        on_image=image_sender(on_event) if on_event is not None else None,
+        should_stop=should_stop,
+        height=resolution,
+        width=resolution,
+    )
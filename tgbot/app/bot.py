@@ -1,28 +1,59 @@
 import asyncio
-import io
+import hashlib
 import logging
 import mimetypes
+import multiprocessing
 import os
+import pathlib
+import time
+import urllib.parse
 
 import aiohttp
-import magic
 from aiogram import Bot, Dispatcher, F, types
+from aiogram.exceptions import TelegramBadRequest
 from aiogram.filters import Command, CommandStart, StateFilter
 from aiogram.fsm.context import FSMContext
 from aiogram.fsm.state import State, StatesGroup, default_state
-from aiogram.fsm.storage.memory import MemoryStorage
 from aiogram.types import (BotCommand, BufferedInputFile, CallbackQuery,
-                           InlineKeyboardButton, InlineKeyboardMarkup,
-                           InputMediaPhoto, KeyboardButton, Message, PhotoSize,
+                           FSInputFile, InlineKeyboardButton,
+                           InlineKeyboardMarkup, InputFile, InputMediaPhoto,
+                           KeyboardButton, Message, PhotoSize,
                            ReplyKeyboardMarkup, ReplyKeyboardRemove)
-from aiogram.utils.media_group import MediaGroupBuilder
+from aiogram.webhook.aiohttp_server import (SimpleRequestHandler,
+                                            setup_application)
+from aiohttp import web
+
+from file_ids import FileIdCache
+from fsm_storage import SQLiteStorage
+
+APP_DIR = pathlib.Path(__file__).parent.resolve()
 
 # полученный у @BotFather
 BOT_TOKEN = os.environ.get('TGBOT_API_TOKEN')
 API_URL = os.environ.get('API_URL', 'http://localhost:8000')
-
-# Инициализируем хранилище (создаем экземпляр класса MemoryStorage)
-storage = MemoryStorage()
+# папка static API, если бот запущен рядом с API и видит общий /storage (например /storage/static):
+# картинки читаются прямо с диска, без HTTP
+SHARED_STATIC_DIR = os.environ.get('SHARED_STATIC_DIR')
+
+# polling - один процесс сам забирает апдейты у Telegram;
+# webhook - Telegram присылает апдейты на WEBHOOK_URL, их принимают BOT_WORKERS процессов на одном порту
+BOT_MODE = os.environ.get('BOT_MODE', 'polling')
+WEBHOOK_URL = os.environ.get('WEBHOOK_URL', '')
+WEBHOOK_PATH = os.environ.get('WEBHOOK_PATH', '/webhook')
+WEBHOOK_SECRET = os.environ.get('WEBHOOK_SECRET') or None
+WEBHOOK_HOST = os.environ.get('WEBHOOK_HOST', '0.0.0.0')
+WEBHOOK_PORT = int(os.environ.get('WEBHOOK_PORT', 8080))
+BOT_WORKERS = int(os.environ.get('BOT_WORKERS', os.cpu_count() or 1))
+
+# завершенные статусы задачи, как в api/app/jobs.py
+FINISHED = ('done', 'error', 'cancelled')
+
+# Инициализируем хранилище: анкеты лежат в sqlite, общей для всех процессов бота,
+# и не теряются при перезапуске
+storage = SQLiteStorage(os.environ.get('FSM_STORAGE_PATH') or APP_DIR / '../storage/fsm.sqlite3')
+
+# file_id отправленных картинок по хэшу содержимого, переживает перезапуск бота
+file_ids = FileIdCache(os.environ.get('FILE_ID_CACHE_PATH') or APP_DIR / '../storage/file_ids.sqlite3')
 
 # Включаем логирование, чтобы не пропустить важные сообщения
 logging.basicConfig(level=logging.INFO)
@@ -46,6 +77,189 @@ dp = Dispatcher(storage=storage)
 #     }
 # }
 
+# не чаще, чем раз в столько секунд, обновляем сообщение с прогрессом обучения
+PROGRESS_UPDATE_INTERVAL = 5
+# сколько секунд API держит long-poll запрос о задаче и пауза перед повтором после ошибки сети
+JOB_POLL_WAIT = 30
+JOB_RETRY_DELAY = 5
+# запросы к API короткие - задача выполняется в фоне, ответ забираем через /jobs/{id}
+API_TIMEOUT = aiohttp.ClientTimeout(total=JOB_POLL_WAIT + 60)
+# одна сессия с пулом соединений на весь бот; long-poll держит соединение на каждую ждущую задачу,
+# поэтому пул должен быть больше числа пользователей, одновременно ждущих результат
+API_POOL_SIZE = int(os.environ.get('API_POOL_SIZE', 100))
+# фото из Telegram идут в запрос к API такими кусками
+TELEGRAM_CHUNK_SIZE = 64 * 1024
+# сколько картинок и фото скачиваем одновременно
+FETCH_CONCURRENCY = int(os.environ.get('FETCH_CONCURRENCY', 4))
+fetch_semaphore = asyncio.Semaphore(FETCH_CONCURRENCY)
+# в одной медиагруппе Telegram не больше 10 фото
+MEDIA_GROUP_MAX_SIZE = 10
+
+
+# путь к картинке в общем /storage или None, если его не видно
+def shared_static_path(url: str) -> pathlib.Path | None:
+    if not SHARED_STATIC_DIR:
+        return None
+    url_path = urllib.parse.unquote(urllib.parse.urlparse(url).path)
+    if not url_path.startswith('/static/'):
+        return None
+    static_dir = pathlib.Path(SHARED_STATIC_DIR).resolve()
+    path = (static_dir / url_path.removeprefix('/static/')).resolve()
+    if not path.is_relative_to(static_dir) or not path.is_file():
+        return None
+    return path
+
+
+def file_sha256(path: pathlib.Path) -> str:
+    sha256 = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b''):
+            sha256.update(chunk)
+    return sha256.hexdigest()
+
+
+# картинка по урлу из ответа API и sha256 ее содержимого:
+# файл из общего /storage или байты, скачанные одним буфером
+async def fetch_photo(session: aiohttp.ClientSession, url: str) -> tuple[InputFile, str]:
+    # convert http://localhost:8000/static/telegram_411554990/tatto1.png to telegram_411554990_tatto1.png
+    filename = '_'.join(url.split('/')[-2:])
+    path = await asyncio.to_thread(shared_static_path, url)
+    if path is not None:
+        # https://docs.aiogram.dev/en/latest/api/upload_file.html#upload-from-file-system
+        return FSInputFile(path, filename=filename), await asyncio.to_thread(file_sha256, path)
+
+    async with fetch_semaphore:
+        async with session.get(url=url) as response:
+            response.raise_for_status()
+            content = await response.read()
+    # https://docs.aiogram.dev/en/latest/api/upload_file.html#upload-from-buffer
+    return BufferedInputFile(content, filename=filename), hashlib.sha256(content).hexdigest()
+
+
+# скачиваем картинки одновременно и отправляем пользователю одним сообщением
+async def send_photos(session: aiohttp.ClientSession, message: Message, urls: list[str]):
+    photos = await asyncio.gather(*[fetch_photo(session, url) for url in urls])
+    for i in range(0, len(photos), MEDIA_GROUP_MAX_SIZE):
+        await send_photo_group(message, photos[i:i + MEDIA_GROUP_MAX_SIZE])
+
+
+# уже отправленные раньше картинки идут ссылкой на file_id, остальные загружаются,
+# и их file_id запоминаются для следующих отправок
+async def send_photo_group(message: Message, photos: list[tuple[InputFile, str]]):
+    media = [file_ids.get(bot.id, sha256) or photo for photo, sha256 in photos]
+    try:
+        sent_messages = await send_media(message, media)
+    except TelegramBadRequest:
+        cached = [sha256 for (_, sha256), item in zip(photos, media) if isinstance(item, str)]
+        if not cached:
+            raise
+        # file_id устарел - забываем его и загружаем картинки заново
+        for sha256 in cached:
+            file_ids.delete(bot.id, sha256)
+        media = [photo for photo, _ in photos]
+        sent_messages = await send_media(message, media)
+
+    for (_, sha256), item, sent_message in zip(photos, media, sent_messages):
+        if not isinstance(item, str) and sent_message.photo:
+            file_ids.set(bot.id, sha256, sent_message.photo[-1].file_id)
+
+
+async def send_media(message: Message, media: list[InputFile | str]) -> list[Message]:
+    if len(media) == 1:
+        return [await bot.send_photo(chat_id=message.chat.id, photo=media[0])]
+    return await bot.send_media_group(
+        chat_id=message.chat.id,
+        media=[InputMediaPhoto(media=item) for item in media]
+    )
+
+
+# путь к фото пользователя на серверах Telegram и имя файла для API
+# https://docs.aiogram.dev/en/latest/api/download_file.html
+async def get_telegram_photo(photo_id: str, photo_unique_id: str) -> tuple[str, str]:
+    async with fetch_semaphore:
+        file = await bot.get_file(photo_id)
+    return file.file_path, f'{photo_unique_id}{pathlib.PurePosixPath(file.file_path).suffix or ".jpg"}'
+
+
+# фото скачивается из Telegram прямо во время отправки запроса к API,
+# кусками по TELEGRAM_CHUNK_SIZE, и целиком в памяти не лежит
+def add_telegram_photo(request_data: aiohttp.FormData, file_path: str, filename: str):
+    request_data.add_field(
+        'files',
+        bot.session.stream_content(
+            url=bot.session.api.file_url(bot.token, file_path),
+            chunk_size=TELEGRAM_CHUNK_SIZE,
+        ),
+        filename=filename,
+        content_type=mimetypes.guess_type(filename)[0] or 'image/jpeg',
+    )
+
+
+# отправляем задачу в API и сразу получаем ее id
+async def submit_job(session: aiohttp.ClientSession, message: Message, url: str, **kwargs) -> str | None:
+    async with session.post(url, **kwargs) as resp:
+        server_response = await resp.json()
+    if 'id' not in server_response:
+        await message.answer(
+            text=f'Не удалось отправить задачу\n\n{str(server_response)}\n\n'
+        )
+        return None
+    return server_response['id']
+
+
+# ждем задачу через long-poll: показываем прогресс обучения
+# и отправляем каждую картинку, как только она появилась в задаче
+async def wait_job(session: aiohttp.ClientSession, message: Message, job_id: str):
+    progress_message = None
+    progress_updated_at = 0
+    updated_after = 0
+    sent_images = 0
+    while True:
+        request = session.get(
+            f'{API_URL}/jobs/{job_id}',
+            params={'wait': JOB_POLL_WAIT, 'updated_after': updated_after}
+        )
+        try:
+            async with request as resp:
+                job = await resp.json()
+        except (aiohttp.ClientError, asyncio.TimeoutError):
+            # API перезапускается - состояние задачи сохранено, просто спрашиваем еще раз
+            await asyncio.sleep(JOB_RETRY_DELAY)
+            continue
+
+        if 'status' not in job:
+            await message.answer(
+                text=f'Не могу найти задачу\n\n{str(job)}\n\n'
+            )
+            return
+        updated_after = job['updated_at']
+
+        progress = job.get('progress')
+        if progress and time.monotonic() - progress_updated_at >= PROGRESS_UPDATE_INTERVAL:
+            progress_updated_at = time.monotonic()
+            text = f'Обучение: шаг {progress["step"]} из {progress["total"]}'
+            if progress_message is None:
+                progress_message = await message.answer(text=text)
+            elif progress_message.text != text:
+                progress_message = await progress_message.edit_text(text=text)
+
+        # вариант под Telegram в разы меньше оригинала, а качество после пережатия Telegram то же;
+        # все новые картинки качаются одновременно
+        new_images = [urls.get('telegram') or urls['original'] for urls in job['variants'][sent_images:]]
+        if new_images:
+            await send_photos(session, message, new_images)
+            sent_images += len(new_images)
+
+        if job['status'] in FINISHED:
+            if job['status'] == 'cancelled':
+                await message.answer(text='Задача отменена')
+            elif job['error'] or not job['generated_images']:
+                await message.answer(
+                    text=f'Не могу найти картинки в результатах\n\n{str(job)}\n\n'
+                )
+            return
+
+
 # Cоздаем класс, наследуемый от StatesGroup, для группы состояний нашей FSM
 class FSMFillForm(StatesGroup):
     # Создаем экземпляры класса State, последовательно
@@ -170,31 +384,34 @@ async def warning_not_gender(message: Message):
     )
 
 
+# фото анкеты хранятся каждое под своим ключом "photo:<file_unique_id>"
+PHOTO_KEY_PREFIX = 'photo:'
+
+
+def photo_entries(data: dict) -> list[dict]:
+    return [value for key, value in data.items() if key.startswith(PHOTO_KEY_PREFIX)]
+
+
 # Этот хэндлер будет срабатывать, если отправлено фото
-# и переводить в состояние ввода promt
-@dp.message(StateFilter(FSMFillForm.files),
+# и переводить в состояние ввода promt;
+# фото из одного альбома приходят отдельными апдейтами, остальные - уже в состоянии ввода promt
+@dp.message(StateFilter(FSMFillForm.files, FSMFillForm.promt),
             F.photo[-1].as_('largest_photo'))
 async def process_photo_sent(message: Message,
                              state: FSMContext,
                              largest_photo: PhotoSize):
     # Cохраняем данные фото (file_unique_id и file_id) в хранилище
-    # по ключам "photo_unique_id" и "photo_id"
-    is_empty = False
-    data = await state.get_data()
-    files = data.get('files')
-    if not files:
-        is_empty = True
-        files = {}
-    files[largest_photo.file_unique_id] = {
-        'photo_unique_id': largest_photo.file_unique_id,
-        'photo_id': largest_photo.file_id
-    }
-    await state.update_data(
-        files=files
-    )
+    # по ключам "photo_unique_id" и "photo_id"; у каждого фото свой ключ, а update_data атомарен,
+    # поэтому фото, обработанные одновременно в разных процессах, не затирают друг друга
+    data = await state.update_data({
+        f'{PHOTO_KEY_PREFIX}{largest_photo.file_unique_id}': {
+            'photo_unique_id': largest_photo.file_unique_id,
+            'photo_id': largest_photo.file_id
+        }
+    })
 
     # Если обрабатываем первую фотографию
-    if is_empty:
+    if len(photo_entries(data)) == 1:
         await message.answer(
             text='Введите свой promt',
             reply_markup=ReplyKeyboardRemove()
@@ -218,7 +435,7 @@ async def warning_not_photo(message: Message):
 # Этот хэндлер будет срабатывать на ввод promt
 # выводить из машины состояний
 @dp.message(StateFilter(FSMFillForm.promt))
-async def process_promt_sent(message: Message, state: FSMContext):
+async def process_promt_sent(message: Message, state: FSMContext, api_session: aiohttp.ClientSession):
     # Cохраняем имя в хранилище по ключу "promt"
     await state.update_data(promt=message.text)
     # Добавляем в "базу данных" анкету пользователя
@@ -232,49 +449,23 @@ async def process_promt_sent(message: Message, state: FSMContext):
         text='Спасибо! Ваши данные сохранены! Пришлем результат когда все будет готово\n\n'
     )
     
-    timeout = aiohttp.ClientTimeout(total=3600)
-    async with aiohttp.ClientSession(timeout=timeout) as session:
-        request_data = aiohttp.FormData()
-        request_data.add_field('fio', f'telegram_{message.from_user.id}')
-        request_data.add_field('gender', data['gender'])
-        request_data.add_field('name_of_model', data['name_of_model'])
-        request_data.add_field('promt', data['promt'])
-
-        for fille_data in data['files'].values():
-            # https://docs.aiogram.dev/en/latest/api/download_file.html
-            file = await bot.download(fille_data['photo_id'])
-            file_format = magic.from_buffer(file.read(2048), True)
-            file.seek(0)
-            file_extension = mimetypes.guess_extension(file_format) or '.jpg'
-            request_data.add_field('files', file, filename=f'{fille_data["photo_unique_id"]}{file_extension}')
-
-        generated_image_urls = []
-        request = session.post(f'{API_URL}/input_train/', data=request_data)
-        async with request as resp:
-            server_response = await resp.json()
-            if 'generated_images' not in server_response:
-                await message.answer(
-                    text=f'Не могу найти картинки в результатах\n\n{str(server_response)}\n\n'
-                )
+    request_data = aiohttp.FormData()
+    request_data.add_field('fio', f'telegram_{message.from_user.id}')
+    request_data.add_field('gender', data['gender'])
+    request_data.add_field('name_of_model', data['name_of_model'])
+    request_data.add_field('promt', data['promt'])
+
+    # ссылки на файлы запрашиваем одновременно, сами файлы скачиваются уже при отправке запроса
+    photos = await asyncio.gather(*[
+        get_telegram_photo(fille_data['photo_id'], fille_data['photo_unique_id'])
+        for fille_data in photo_entries(data)
+    ])
+    for file_path, filename in photos:
+        add_telegram_photo(request_data, file_path, filename)
 
-            generated_image_urls = server_response['generated_images']
-        
-        # https://docs.aiogram.dev/en/latest/utils/media_group.html#usage
-        # https://stackoverflow.com/questions/78285221/send-multiple-photos-with-text-aiogram
-        if generated_image_urls:
-            media_group = MediaGroupBuilder(caption='Результат')
-            for item in generated_image_urls:
-                async with session.get(url=item) as response:
-                    response.auto_decompress = False
-                    buffer = io.BytesIO(await response.read())
-                    buffer.seek(0)
-                    # convert http://localhost:8000/static/telegram_411554990/tatto1.png to telegram_411554990_tatto1.png
-                    caption = '_'.join(item.split('/')[-2:])
-                    # https://docs.aiogram.dev/en/latest/api/upload_file.html#upload-from-buffer
-                    media = BufferedInputFile(buffer.read(), filename=caption)
-                    media_group.add(type='photo', media=media)
-
-            await bot.send_media_group(chat_id=message.chat.id, media=media_group.build())
+    job_id = await submit_job(api_session, message, f'{API_URL}/jobs/train/', data=request_data)
+    if job_id:
+        await wait_job(api_session, message, job_id)
 
 
 #--------------------------------------------------------------------------------------------------------------    
@@ -343,7 +534,7 @@ async def warning_not_gender(message: Message):
 # Этот хэндлер будет срабатывать на ввод promt
 # выводить из машины состояний
 @dp.message(StateFilter(FSMInferenceForm.promt))
-async def process_promt_sent(message: Message, state: FSMContext):
+async def process_promt_sent(message: Message, state: FSMContext, api_session: aiohttp.ClientSession):
     # Cохраняем имя в хранилище по ключу "promt"
     await state.update_data(promt=message.text)
     # Добавляем в "базу данных" анкету пользователя
@@ -357,40 +548,13 @@ async def process_promt_sent(message: Message, state: FSMContext):
         text='Спасибо! Ваши данные сохранены! Пришлем результат когда все будет готово\n\n'
     )
     
-    timeout = aiohttp.ClientTimeout(total=3600)
-    async with aiohttp.ClientSession(timeout=timeout) as session:
-        generated_image_urls = []
-        request = session.post(f'{API_URL}/input_inference/', json={
-            'fio': f'telegram_{message.from_user.id}',
-            'gender': data['gender'],
-            'promt': data['promt'],
-        })
-        async with request as resp:
-            server_response = await resp.json()
-            if 'generated_images' not in server_response:
-                await message.answer(
-                    text=f'Не могу найти картинки в результатах\n\n{str(server_response)}\n\n'
-                )
-                return
-
-            generated_image_urls = server_response['generated_images']
-        
-        # https://docs.aiogram.dev/en/latest/utils/media_group.html#usage
-        # https://stackoverflow.com/questions/78285221/send-multiple-photos-with-text-aiogram
-        if generated_image_urls:
-            media_group = MediaGroupBuilder(caption='Результат')
-            for item in generated_image_urls:
-                async with session.get(url=item) as response:
-                    response.auto_decompress = False
-                    buffer = io.BytesIO(await response.read())
-                    buffer.seek(0)
-                    # convert http://localhost:8000/static/telegram_411554990/tatto1.png to telegram_411554990_tatto1.png
-                    caption = '_'.join(item.split('/')[-2:])
-                    # https://docs.aiogram.dev/en/latest/api/upload_file.html#upload-from-buffer
-                    media = BufferedInputFile(buffer.read(), filename=caption)
-                    media_group.add(type='photo', media=media)
-
-            await bot.send_media_group(chat_id=message.chat.id, media=media_group.build())
+    job_id = await submit_job(api_session, message, f'{API_URL}/jobs/inference/', json={
+        'fio': f'telegram_{message.from_user.id}',
+        'gender': data['gender'],
+        'promt': data['promt'],
+    })
+    if job_id:
+        await wait_job(api_session, message, job_id)
 
 
 #--------------------------------------------------------------------------------------------------------------  
@@ -401,10 +565,70 @@ async def send_echo(message: Message):
     await message.reply(text='Извините, не понимаю')
 
 
+# сессия к API создается при запуске бота и попадает в хэндлеры аргументом api_session
+# https://docs.aiogram.dev/en/latest/dispatcher/dependency_injection.html
+@dp.startup()
+async def on_startup(dispatcher: Dispatcher):
+    dispatcher['api_session'] = aiohttp.ClientSession(
+        timeout=API_TIMEOUT,
+        connector=aiohttp.TCPConnector(
+            limit=API_POOL_SIZE,
+            limit_per_host=API_POOL_SIZE,
+            keepalive_timeout=60,
+            ttl_dns_cache=300,
+        ),
+    )
+
+
+@dp.shutdown()
+async def on_shutdown(dispatcher: Dispatcher):
+    await dispatcher['api_session'].close()
+    file_ids.close()
+    await storage.close()
+
+
 # Запуск процесса поллинга новых апдейтов
-async def main():
+async def start_polling():
     await set_main_menu(bot)
+    # Telegram не отдает апдейты поллингом, пока установлен webhook
+    await bot.delete_webhook()
     await dp.start_polling(bot)
 
+
+# webhook регистрируется один раз, до запуска процессов
+# https://docs.aiogram.dev/en/latest/dispatcher/webhook.html
+async def set_webhook():
+    await set_main_menu(bot)
+    await bot.set_webhook(
+        f'{WEBHOOK_URL}{WEBHOOK_PATH}',
+        secret_token=WEBHOOK_SECRET,
+        allowed_updates=dp.resolve_used_update_types(),
+    )
+    await bot.session.close()
+
+
+# один процесс приема апдейтов; благодаря reuse_port все процессы слушают один порт,
+# и ядро распределяет между ними входящие соединения; хэндлеры выполняются в фоне,
+# Telegram получает ответ сразу, не дожидаясь долгой задачи
+def run_webhook_worker():
+    app = web.Application()
+    SimpleRequestHandler(dispatcher=dp, bot=bot, secret_token=WEBHOOK_SECRET).register(app, path=WEBHOOK_PATH)
+    setup_application(app, dp, bot=bot)
+    web.run_app(app, host=WEBHOOK_HOST, port=WEBHOOK_PORT, reuse_port=True)
+
+
+def main():
+    if BOT_MODE == 'webhook':
+        asyncio.run(set_webhook())
+        # spawn, а не fork: соединения с sqlite и сессии aiohttp не переживают fork
+        context = multiprocessing.get_context('spawn')
+        workers = [context.Process(target=run_webhook_worker) for _ in range(BOT_WORKERS)]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+    else:
+        asyncio.run(start_polling())
+
 if __name__ == '__main__':
-    asyncio.run(main())
+    main()
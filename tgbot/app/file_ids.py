@@ -0,0 +1,45 @@
+# https://core.telegram.org/bots/api#sending-files
+import pathlib
+import sqlite3
+import time
+
+
+class FileIdCache():
+    # file_id уже отправленных картинок по sha256 содержимого: повторно та же картинка
+    # отправляется ссылкой на файл на серверах Telegram, без загрузки байтов;
+    # file_id действителен только для того бота, который его получил, поэтому ключ включает id бота
+    def __init__(self, path: str):
+        self.path = pathlib.Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+
+        self.db = sqlite3.connect(self.path, isolation_level=None)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute('''
+            CREATE TABLE IF NOT EXISTS file_ids (
+                bot_id INTEGER NOT NULL,
+                sha256 TEXT NOT NULL,
+                file_id TEXT NOT NULL,
+                created_at REAL NOT NULL,
+                PRIMARY KEY (bot_id, sha256)
+            )
+        ''')
+
+    def get(self, bot_id: int, sha256: str) -> str | None:
+        row = self.db.execute(
+            'SELECT file_id FROM file_ids WHERE bot_id = ? AND sha256 = ?',
+            (bot_id, sha256)
+        ).fetchone()
+        return row[0] if row else None
+
+    def set(self, bot_id: int, sha256: str, file_id: str):
+        self.db.execute(
+            'INSERT OR REPLACE INTO file_ids (bot_id, sha256, file_id, created_at) VALUES (?, ?, ?, ?)',
+            (bot_id, sha256, file_id, time.time())
+        )
+
+    # Telegram больше не знает этот file_id - в следующий раз картинка загрузится заново
+    def delete(self, bot_id: int, sha256: str):
+        self.db.execute('DELETE FROM file_ids WHERE bot_id = ? AND sha256 = ?', (bot_id, sha256))
+
+    def close(self):
+        self.db.close()
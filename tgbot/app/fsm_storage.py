@@ -0,0 +1,95 @@
+# https://docs.aiogram.dev/en/latest/dispatcher/finite_state_machine/storages.html
+import asyncio
+import json
+import pathlib
+import sqlite3
+import threading
+from typing import Any
+
+from aiogram.fsm.state import State
+from aiogram.fsm.storage.base import BaseStorage, StateType, StorageKey
+
+
+class SQLiteStorage(BaseStorage):
+    # состояние и данные анкет в sqlite: одна база на все процессы бота, анкеты переживают перезапуск;
+    # запросы идут в отдельном потоке - ожидание блокировки, которую держит другой процесс, не останавливает event loop
+    def __init__(self, path: str, timeout: float = 10):
+        self.path = pathlib.Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+
+        self.db = sqlite3.connect(self.path, isolation_level=None, check_same_thread=False, timeout=timeout)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute('''
+            CREATE TABLE IF NOT EXISTS fsm (
+                key TEXT PRIMARY KEY,
+                state TEXT,
+                data TEXT NOT NULL DEFAULT '{}'
+            )
+        ''')
+        # одно соединение на процесс, потоки to_thread пользуются им по очереди
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def build_key(key: StorageKey) -> str:
+        parts = (
+            key.bot_id,
+            key.chat_id,
+            key.user_id,
+            key.thread_id,
+            getattr(key, 'business_connection_id', None),
+            key.destiny,
+        )
+        return ':'.join('' if part is None else str(part) for part in parts)
+
+    async def execute(self, func, *args):
+        def locked():
+            with self.lock:
+                return func(*args)
+        return await asyncio.to_thread(locked)
+
+    async def set_state(self, key: StorageKey, state: StateType = None) -> None:
+        state = state.state if isinstance(state, State) else state
+        await self.execute(self._set, self.build_key(key), 'state', state)
+
+    async def get_state(self, key: StorageKey) -> str | None:
+        row = await self.execute(self._get, self.build_key(key))
+        return row[0] if row else None
+
+    async def set_data(self, key: StorageKey, data: dict[str, Any]) -> None:
+        await self.execute(self._set, self.build_key(key), 'data', json.dumps(data, ensure_ascii=False))
+
+    async def get_data(self, key: StorageKey) -> dict[str, Any]:
+        row = await self.execute(self._get, self.build_key(key))
+        return json.loads(row[1]) if row else {}
+
+    # в отличие от BaseStorage.update_data чтение и запись идут в одной транзакции:
+    # одновременные изменения одной анкеты из разных процессов не затирают друг друга
+    async def update_data(self, key: StorageKey, data: dict[str, Any]) -> dict[str, Any]:
+        return await self.execute(self._update_data, self.build_key(key), data)
+
+    async def close(self) -> None:
+        await self.execute(self.db.close)
+
+    def _get(self, key: str):
+        return self.db.execute('SELECT state, data FROM fsm WHERE key = ?', (key,)).fetchone()
+
+    def _set(self, key: str, column: str, value):
+        self.db.execute(
+            f'INSERT INTO fsm (key, {column}) VALUES (?, ?) ON CONFLICT(key) DO UPDATE SET {column} = excluded.{column}',
+            (key, value)
+        )
+        # после state.clear() запись пустая - удаляем ее
+        self.db.execute("DELETE FROM fsm WHERE key = ? AND state IS NULL AND data = '{}'", (key,))
+
+    def _update_data(self, key: str, data: dict[str, Any]) -> dict[str, Any]:
+        # BEGIN IMMEDIATE сразу берет блокировку на запись, другой процесс ждет до конца транзакции
+        self.db.execute('BEGIN IMMEDIATE')
+        try:
+            row = self._get(key)
+            merged = {**(json.loads(row[1]) if row else {}), **data}
+            self._set(key, 'data', json.dumps(merged, ensure_ascii=False))
+            self.db.execute('COMMIT')
+        except BaseException:
+            self.db.execute('ROLLBACK')
+            raise
+        return merged